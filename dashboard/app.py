@@ -18,6 +18,11 @@ app.daydf = pd.DataFrame()
 app.comp_names = []
 server = app.server
 
+@server.route("/pool")
+def pool_stats():
+    """Connections of the database pool and time the requests waited for them"""
+    return db.pool_stats()
+
 from index import layout  # Not before app is defined since we use it
 app.layout = layout
 
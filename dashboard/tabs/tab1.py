@@ -8,15 +8,6 @@ import dash_bootstrap_components as dbc
 import plotly.express as px
 
 from app import app, db
-companies = db.df_query("""
-    SELECT companies.id AS cid, companies.name
-    FROM companies
-    INNER JOIN stocks ON stocks.cid = companies.id
-    GROUP BY companies.id, companies.name
-""")
-
-# Debug : Vérifie les données récupérées
-print("🔍 Companies disponibles :", companies)
 
 tab1_layout = html.Div([
     html.H2("Analyse d'un Cours Boursiers"),
@@ -124,15 +115,14 @@ def load_single_stock_options(active_tab):
     if active_tab != 'tab-1':
         return [],[], []
 
+    # the companies with daily values, one index probe each instead of a scan of the ticks
     df = db.df_query("""
         SELECT id, name
-        FROM companies
-        JOIN stocks ON stocks.cid = id
-        GROUP BY id, name
+        FROM companies c
+        WHERE EXISTS (SELECT 1 FROM daystocks_all d WHERE d.cid = c.id)
     """)
     
     options = [{'label': row['name'], 'value': row['id']} for _, row in df.iterrows()]
-    print("✅ Options 'dropdown' chargées dynamiquement :", options)
     return options, options, options
 
 @app.callback(
@@ -147,21 +137,21 @@ def update_single_stock_graph(selected_stock_id, start_date, end_date, chart_typ
         print(f"parametre empty.{selected_stock_id}, {start_date}, {end_date}")
         return go.Figure()  # Graph vide
     
+    # possibly years of ticks: binary COPY read by numpy, no Python object per row
     query = """
         SELECT date, cid, value, volume
         FROM stocks
-        JOIN companies ON stocks.cid = companies.id
-        WHERE companies.id = '%s'
-        AND date BETWEEN '%s' AND '%s'
+        WHERE cid = %s
+        AND date BETWEEN %s AND %s
         ORDER BY date
     """
-    df = db.df_query(query, (selected_stock_id, start_date, end_date))
+    df = pd.DataFrame(db.np_query(query, (selected_stock_id, start_date, end_date)))
 
     query = """
         SELECT d.date AS date, d.open AS open, d.close AS close, d.high AS high, d.low AS low
-        FROM daystocks d
+        FROM daystocks_all d
         JOIN companies c ON d.cid = c.id
-        WHERE c.id = '%s' AND d.date BETWEEN '%s' AND '%s'
+        WHERE c.id = %s AND d.date BETWEEN %s AND %s
     """
 
     df2 = db.df_query(query, (selected_stock_id, start_date, end_date))
@@ -195,17 +185,16 @@ def update_multi_stock_graph(selected_stocks_id, start_date, end_date):
     if not selected_stocks_id or not start_date or not end_date:
         return go.Figure()
 
-    placeholders = ', '.join(['%s'] * len(selected_stocks_id))
-    query = f"""
+    # one array parameter: the same prepared query whatever the number of actions
+    query = """
         SELECT stocks.date, companies.name, stocks.value, stocks.volume
         FROM stocks
         JOIN companies ON stocks.cid = companies.id
-        WHERE companies.id IN ({placeholders})
-        AND stocks.date BETWEEN '%s' AND '%s'
+        WHERE companies.id = ANY(%s::int[])
+        AND stocks.date BETWEEN %s AND %s
         ORDER BY stocks.date
     """
-    params = selected_stocks_id + [start_date, end_date]
-    df = db.df_query(query, tuple(params))
+    df = db.df_query(query, (list(selected_stocks_id), start_date, end_date))
 
     if df.empty:
         return go.Figure()
@@ -229,6 +218,37 @@ def update_multi_stock_graph(selected_stocks_id, start_date, end_date):
     )
 
     return fig
+def bollinger(chunks, window=20, max_points=5000):
+    """Moving average and standard deviation of value over window ticks, chunk by chunk.
+
+    The last window - 1 values of a chunk are carried over to the next one, so the
+    result is the same as with the whole series. One point out of step is kept and
+    step doubles when more than max_points are kept: memory stays bounded whatever
+    the number of ticks of the company.
+    """
+    carry = None
+    kept = []
+    step, seen = 1, 0
+    for chunk in chunks:
+        df = chunk[['date', 'value']]
+        skip = 0
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+            skip = len(carry)
+        carry = df.iloc[-(window - 1):]
+        rolling = df['value'].rolling(window=window)
+        df = df.assign(ma20=rolling.mean(), std20=rolling.std()).iloc[skip:]
+        df = df.assign(n=range(seen, seen + len(df)))
+        seen += len(df)
+        kept.append(df[df['n'] % step == 0])
+        if sum(len(k) for k in kept) > max_points:
+            step *= 2
+            df = pd.concat(kept)
+            kept = [df[df['n'] % step == 0]]
+    if not kept:
+        return pd.DataFrame()
+    return pd.concat(kept, ignore_index=True).drop(columns='n')
+
 @app.callback(
     ddep.Output('bollinger-stock-graph', 'figure'),
     ddep.Input('bollinger-stock-dropdown', 'value')
@@ -238,22 +258,20 @@ def update_bollinger_stock_graph(selected_stock_id):
     if not selected_stock_id:
         return go.Figure()
 
+    # all the ticks of a company can be a lot: they are read and reduced by chunks
     query = """
-        SELECT date, cid, value, volume
+        SELECT date, value
         FROM stocks
-        JOIN companies ON stocks.cid = companies.id
-        WHERE companies.id = '%s'
+        WHERE cid = %s
         ORDER BY date
     """
 
-    df = db.df_query(query, (selected_stock_id))
+    df = bollinger(db.df_stream(query, (selected_stock_id,), chunksize=100000))
 
     if df.empty:
         print("Aucune donnée trouvée pour cette action.")
         return go.Figure()
 
-    df['ma20'] = df['value'].rolling(window=20).mean()
-    df['std20'] = df['value'].rolling(window=20).std()
     df['upper'] = df['ma20'] + 2 * df['std20']
     df['lower'] = df['ma20'] - 2 * df['std20']
 
@@ -58,7 +58,7 @@ def load_stock_options(active_tab):
     df = db.df_query("""
         SELECT id, name
         FROM companies
-        JOIN daystocks ON daystocks.cid = id
+        JOIN daystocks_all ON daystocks_all.cid = id
         GROUP BY id, name
     """)
     
@@ -78,9 +78,9 @@ def update_stock_data_table(selected_stock_id, start_date, end_date):
 
     query = """
         SELECT d.open, d.close, d.high, d.low, d.mean, d.std
-        FROM daystocks d
+        FROM daystocks_all d
         JOIN companies c ON d.cid = c.id
-        WHERE c.id = '%s' AND d.date BETWEEN '%s' AND '%s'
+        WHERE c.id = %s AND d.date BETWEEN %s AND %s
     """
 
     df = db.df_query(query, (selected_stock_id, start_date, end_date))
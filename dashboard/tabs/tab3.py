@@ -6,6 +6,8 @@ import dash_extensions as de
 
 from app import app, db  # Import these instances
 
+MAX_ROWS = 1000  # rows of a SELECT shown, the others are not even fetched
+
 tab3_layout = dcc.Tab(label='SQL', children=[
     html.H2("SQL Terminal"),
     html.Div(id='sql-query-output', style={'whiteSpace': 'pre-line', 'overflowY': 'auto', 'height': 500, 
@@ -34,6 +36,20 @@ def execute_query(n_key, query, history):
     if n_key is None or not query:
         return history, query
     try:
+        if query.lstrip().upper().startswith('SELECT'):
+            stream = db.df_stream(query, chunksize=MAX_ROWS)
+            try:
+                result_df = next(stream, None)
+                truncated = next(stream, None) is not None
+            finally:
+                stream.close()
+            if result_df is None:
+                error_msg = str(db.logger.get_last_message())
+                if error_msg != "df_stream: " + query:  # as below, an error was logged after the query
+                    return history + [ html.Span("error ", style={'color': 'red'}), html.Pre(error_msg), html.Br() ], query
+                return history + [html.Pre([html.B(query), "(0 lignes)"]), html.Br()], ""
+            note = f"\n({MAX_ROWS} premières lignes)" if truncated else ""
+            return history + [html.Pre([html.B(query), result_df.to_string(), note]), html.Br()], ""
         result_df = db.df_query(query)
         if len(result_df) == 0:
             error_msg = str(db.logger.get_last_message())
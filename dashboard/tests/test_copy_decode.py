@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Décodage du COPY binaire du dashboard (_decode_copy) sur ce qu'encode l'ETL
+  (_encode_binary), comparé à ce que df_query donne des mêmes lignes.
+
+  Les deux dossiers ont un timescaledb_model : ils sont chargés sous deux noms.
+'''
+
+import datetime
+import importlib.util
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(ROOT, "dashboard"))  # mylogging
+
+
+def load(name, path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+etl_model = load("etl_timescaledb_model", "etl/timescaledb_model.py")
+dashboard_model = load("dashboard_timescaledb_model", "dashboard/timescaledb_model.py")
+
+TYPES = {"date": "timestamptz", "cid": "int2", "value": "float4", "volume": "float4"}
+OIDS = [1184, 21, 700, 700]
+
+
+def copy_output(df):
+    """What COPY (SELECT date, cid, value, volume ...) TO STDOUT (FORMAT binary) sends for df"""
+    return (etl_model.PGCOPY_HEADER + etl_model._encode_binary(df, TYPES, "UTC")
+            + etl_model.PGCOPY_TRAILER)
+
+
+def as_df_query(df):
+    """DataFrame df_query makes of the rows psycopg2 returns for df, in a UTC session"""
+    rows = []
+    for date, cid, value, volume in df.itertuples(index=False):
+        rows.append((None if pd.isna(date) else date.to_pydatetime().replace(tzinfo=datetime.timezone.utc),
+                     None if pd.isna(cid) else int(cid),
+                     None if pd.isna(value) else float(np.float32(value)),
+                     None if pd.isna(volume) else float(np.float32(volume))))
+    return dashboard_model._frame(rows, list(TYPES), timezone="UTC")
+
+
+def decoded(df):
+    columns = dashboard_model._decode_copy(memoryview(copy_output(df)), OIDS)
+    return pd.DataFrame(dict(zip(TYPES, columns)))
+
+
+def stocks(n=1000):
+    return pd.DataFrame({"date": pd.date_range("2020-03-28", periods=n, freq="7min"),
+                         "cid": np.full(n, 42, dtype="int16"),
+                         "value": np.linspace(1, 100, n).astype("float32"),
+                         "volume": np.arange(n, dtype="float32")})
+
+
+def test_fixed_width_rows():
+    df = stocks()
+    result = decoded(df)
+    assert [str(t) for t in result.dtypes] == ["datetime64[us]", "int16", "float32", "float32"]
+    expected = as_df_query(df)
+    assert (result["date"].to_numpy() == expected["date"].dt.tz_localize(None).to_numpy()).all()
+    assert (result["cid"].to_numpy() == expected["cid"].to_numpy()).all()
+    np.testing.assert_array_equal(result["value"].to_numpy(), expected["value"].to_numpy(dtype="float32"))
+    np.testing.assert_array_equal(result["volume"].to_numpy(), expected["volume"].to_numpy(dtype="float32"))
+
+
+def test_rows_with_nulls():
+    df = stocks(10).astype({"cid": "Int64"})
+    df.loc[2, "value"] = np.nan
+    df.loc[5, "cid"] = pd.NA
+    df.loc[7, "date"] = pd.NaT
+    # the encoder groups the rows by NULL pattern, a table has no order
+    result = decoded(df).sort_values("volume", ignore_index=True)
+    expected = as_df_query(df).sort_values("volume", ignore_index=True)
+    assert result["date"].isna().tolist() == expected["date"].isna().tolist()
+    known = expected["date"].notna()
+    assert (result["date"][known].to_numpy() == expected["date"][known].dt.tz_localize(None).to_numpy()).all()
+    np.testing.assert_array_equal(result["cid"].to_numpy(dtype="float64"), expected["cid"].to_numpy(dtype="float64"))
+    np.testing.assert_array_equal(result["value"].to_numpy(), expected["value"].to_numpy(dtype="float32"))
+
+
+def test_empty_result():
+    result = decoded(stocks(0))
+    assert len(result) == 0
+    assert [str(t) for t in result.dtypes] == ["datetime64[us]", "int16", "float32", "float32"]
+
+
+def test_wall_clock_matches_df_query():
+    # ce que montrent les graphiques : l'heure de la session, de part et d'autre du passage à l'heure d'été
+    df = stocks(500)
+    utc = decoded(df)["date"].to_numpy()
+    shown = dashboard_model._wall_clock(utc, "Europe/Paris")
+    expected = pd.Series(pd.DatetimeIndex(utc).tz_localize("UTC")).dt.tz_convert("Europe/Paris")
+    assert (shown == expected.dt.tz_localize(None).to_numpy()).all()
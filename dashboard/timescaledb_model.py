@@ -1,16 +1,26 @@
 # -*- coding: utf-8 -*-
  
+import contextlib
 import datetime
+import itertools
+import threading
 import time
 import io
 import os
 import csv
+import re
+import struct
 import psycopg2
 import numpy as np
 import pandas as pd
 import sqlalchemy
 import mylogging
 
+try:
+    import pyarrow as pa
+except ImportError:  # df_stream ne rend alors que des dataframes
+    pa = None
+
 # Pour la table Markets, utilisé aussi dans le constructeur
 # mid, nom, alias, prefix boursorama, symbol SWS
 initial_markets_data = (
@@ -57,16 +67,167 @@ def _psql_insert_copy(table, conn, keys, data_iter):  # mehod used by df_write
         cur.copy_expert(sql=sql, file=s_buf)
 
 
+_cursor_names = itertools.count()
+
+_PLACEHOLDER = re.compile(r"%(s|%)")
+
+
+def _numbered(query):
+    """Query with psycopg2 placeholders numbered for PREPARE: %s -> $1, $2..., %% -> %"""
+    count = 0
+
+    def number(match):
+        nonlocal count
+        if match.group(1) == "%":
+            return "%"
+        count += 1
+        return f"${count}"
+    return _PLACEHOLDER.sub(number, query), count
+
+
+def _in_timezone(times, timezone):
+    """Aware datetime64 column times in timezone, left as it is if pandas does not know timezone"""
+    try:
+        return times.dt.tz_convert(timezone)
+    except Exception:  # a POSIX TimeZone setting such as '<+02>-02'
+        return times
+
+
+def _frame(rows, columns, coerce_float=True, parse_dates=None, timezone=None):
+    """DataFrame of the rows of a cursor, timestamps as datetime64 like pd.read_sql
+
+    timezone -- TimeZone of the session, the timestamptz with several offsets
+                (summer time) are shown in it as psycopg2 gave them
+    """
+    df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=coerce_float)
+    for i, name in enumerate(columns):
+        col = df.iloc[:, i]
+        if parse_dates and name in parse_dates:
+            df.isetitem(i, pd.to_datetime(col, errors="coerce", utc=True))
+        elif col.dtype == object:
+            first = col.dropna().head(1)
+            # left as objects by pandas, each with its offset
+            if len(first) and isinstance(first.iloc[0], datetime.datetime) and first.iloc[0].tzinfo is not None:
+                col = pd.to_datetime(col, utc=True)
+                df.isetitem(i, _in_timezone(col, timezone) if timezone else col)
+    return df
+
+
+# types read by np_query: oid -> (binary format of COPY, numpy dtype returned)
+_COPY_TYPES = {
+    16: ("?", np.bool_),                    # bool
+    21: (">i2", np.int16),                  # smallint
+    23: (">i4", np.int32),                  # integer
+    20: (">i8", np.int64),                  # bigint
+    700: (">f4", np.float32),               # real
+    701: (">f8", np.float64),               # double precision
+    1082: (">i4", "datetime64[D]"),         # date, days since 2000-01-01
+    1114: (">i8", "datetime64[us]"),        # timestamp, µs since 2000-01-01
+    1184: (">i8", "datetime64[us]"),        # timestamptz, µs since 2000-01-01 UTC
+}
+_TEXT_TYPES = {25, 1042, 1043}  # text, char, varchar
+_PG_EPOCH = {1082: 10957, 1114: 946684800000000, 1184: 946684800000000}  # 2000-01-01 in the unit of the type
+_COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+
+def _convert(oid, raw):
+    """numpy array of the type oid from the values as sent by COPY"""
+    if oid in _PG_EPOCH:
+        return (raw.astype(np.int64) + _PG_EPOCH[oid]).astype(_COPY_TYPES[oid][1])
+    return raw.astype(_COPY_TYPES[oid][1])
+
+
+def _wall_clock(utc, timezone):
+    """datetime64 of instants in UTC -> datetime64 of the same instants on the clocks of timezone"""
+    try:
+        local = pd.DatetimeIndex(utc).tz_localize("UTC").tz_convert(timezone).tz_localize(None)
+    except Exception:  # a POSIX TimeZone setting pandas does not know, left in UTC
+        return utc
+    return local.to_numpy().astype(utc.dtype)
+
+
+def _decode_copy(data, oids):
+    """Columns of the output of COPY ... TO STDOUT (FORMAT binary), numpy arrays
+
+    Without NULL and text every row has the same size: all the rows are read at
+    once as a numpy structured array (field count, then size and value of each
+    field) and each column is a field of it. Otherwise see _decode_rows.
+    """
+    if bytes(data[:11]) != _COPY_SIGNATURE:
+        raise ValueError("not a binary COPY output")
+    (extension,) = struct.unpack_from(">i", data, 15)
+    start = 19 + extension
+    if all(oid in _COPY_TYPES for oid in oids):
+        fields = [("count", ">i2")]
+        for i, oid in enumerate(oids):
+            fields += [(f"size{i}", ">i4"), (f"col{i}", _COPY_TYPES[oid][0])]
+        row = np.dtype(fields)
+        body = data[start:len(data) - 2]  # -1 on 2 bytes ends the data
+        if len(body) % row.itemsize == 0:
+            rows = np.frombuffer(body, dtype=row)
+            # a NULL (size -1, no value) shifts the rows, the sizes tell it
+            if (rows["count"] == len(oids)).all() and \
+               all((rows[f"size{i}"] == row[f"col{i}"].itemsize).all() for i in range(len(oids))):
+                return [_convert(oid, rows[f"col{i}"]) for i, oid in enumerate(oids)]
+    return _decode_rows(data, start, oids)
+
+
+def _decode_rows(data, pos, oids):
+    """Columns of a binary COPY output read row by row, for NULLs and text
+
+    NULLs are NaN in float columns, NaT in date columns and None in text ones,
+    integer and bool columns with NULLs become float64.
+    """
+    values = [[] for _ in oids]
+    while True:
+        (count,) = struct.unpack_from(">h", data, pos)
+        pos += 2
+        if count == -1:
+            break
+        for i in range(count):
+            (size,) = struct.unpack_from(">i", data, pos)
+            pos += 4
+            if size == -1:
+                values[i].append(None)
+            else:
+                values[i].append(bytes(data[pos:pos + size]))
+                pos += size
+    columns = []
+    for oid, column in zip(oids, values):
+        if oid in _TEXT_TYPES:
+            columns.append(np.array([v if v is None else v.decode() for v in column], dtype=object))
+            continue
+        present = np.array([v is not None for v in column], dtype=bool)
+        raw = np.frombuffer(b"".join(v for v in column if v is not None), dtype=_COPY_TYPES[oid][0])
+        known = _convert(oid, raw)
+        if present.all():
+            columns.append(known)
+            continue
+        if known.dtype.kind in "biu":
+            known = known.astype(np.float64)
+        result = np.full(len(column), np.datetime64("NaT") if known.dtype.kind == "M" else np.nan, dtype=known.dtype)
+        result[present] = known
+        columns.append(result)
+    return columns
+
+
 class TimescaleStockMarketModel:
     """ Bourse model with TimeScaleDB persistence."""
 
-    def __init__(self, database, user=None, host=None, password=None, port=None, remove_all=False):
+    max_prepared = 100  # prepared statements kept by a connection
+
+    def __init__(self, database, user=None, host=None, password=None, port=None, remove_all=False,
+                 pool_min=5, pool_max=10, pool_timeout=30):
         """Create a TimescaleStockMarketModel
 
         database -- The name of the persistence database.
         user     -- Username to connect with to the database. Same as the
                     database name by default.
         remove_all -- REMOVE ALL DATA from the database
+        pool_min -- connections opened at the start and kept in the pool (one
+                    per gunicorn thread), the first requests do not wait for them
+        pool_max -- connections open at most, beyond that a request waits
+                    pool_timeout seconds for one
         """
         self.__database = database
         self.__user = user or database
@@ -74,7 +235,14 @@ class TimescaleStockMarketModel:
         self.__port = port or 5432
         self.__password = password or ''
         self.__squash = False
-        self.__engine = sqlalchemy.create_engine(f"timescaledb://{self.__user}:{self.__password}@{self.__host}:{self.__port}/{self.__database}")
+        # the pool of the engine is shared by df_query and checkout, pre_ping replaces
+        # the connections closed by a database restart before handing them out
+        self.__engine = sqlalchemy.create_engine(
+            f"timescaledb://{self.__user}:{self.__password}@{self.__host}:{self.__port}/{self.__database}",
+            pool_size=pool_min, max_overflow=max(pool_max - pool_min, 0), pool_timeout=pool_timeout,
+            pool_pre_ping=True, pool_recycle=3600)
+        self.__pool_lock = threading.Lock()
+        self.__pool_waits = {"checkouts": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0}
         # markets
         self.market_id = {a:i+1 for i,a in enumerate([m[2] for m in initial_markets_data])}
         self.market_id2sws = {i+1:w for i,w in enumerate([m[4] for m in initial_markets_data])}
@@ -92,6 +260,21 @@ class TimescaleStockMarketModel:
         if remove_all:
             self._purge_database()
         self._setup_database()
+        # requests use the pool (cf checkout), this connection is only for the setup
+        self.connection.close()
+        self.connection = None
+        self._warm_pool(pool_min)
+
+    def _warm_pool(self, count):
+        """Open count connections of the pool now, they wait idle for the requests"""
+        connections = []
+        try:
+            for _ in range(count):
+                connections.append(self.__engine.raw_connection())
+        except Exception as e:  # the requests will open them later
+            self.logger.warning(f"pool: {len(connections)} connections opened out of {count}: {e}")
+        for connection in connections:
+            connection.close()  # back to the pool, open
 
     def _connect_to_database(self, retry_limit=5, retry_delay=1):
         """
@@ -180,11 +363,12 @@ class TimescaleStockMarketModel:
             print(f"Error dropping hypertable: {e}")
             self.connection.rollback()  # Rollback the current transaction
 
-    def _create_index(self, table_name, index_name, columns, commit=False):
+    def _create_index(self, table_name, index_name, columns, unique=False, commit=False):
         """Create an index in the database."""
         cursor = self.connection.cursor()
         try:
-            cursor.execute(f"CREATE INDEX {index_name} ON {table_name} ({columns});")
+            kind = "UNIQUE INDEX" if unique else "INDEX"
+            cursor.execute(f"CREATE {kind} {index_name} ON {table_name} ({columns});")
             if commit:
                 self.connection.commit()
         except Exception as e:
@@ -202,6 +386,58 @@ class TimescaleStockMarketModel:
             print(f"Error dropping index: {e}")
             self.connection.rollback()  # Rollback the current transaction
 
+    def _drop_view(self, view_name, materialized=False, commit=False):
+        """Drop a view from the database."""
+        cursor = self.connection.cursor()
+        kind = "MATERIALIZED VIEW" if materialized else "VIEW"
+        try:
+            cursor.execute(f"DROP {kind} IF EXISTS {view_name} CASCADE;")
+            if commit:
+                self.connection.commit()
+        except Exception as e:
+            print(f"Error dropping view: {e}")
+            self.connection.rollback()  # Rollback the current transaction
+
+    def _create_daystocks_views(self):
+        """Daily values computed from stocks, for the companies Euronext does not cover.
+
+        daystocks_intraday is a continuous aggregate of stocks by day, refreshed by
+        a TimescaleDB policy for the last days and by the ETL after a load.
+        Boursorama volumes are cumulated over the day so the daily volume is the
+        max. daystocks_all is what the dashboard reads: the Euronext daystocks
+        and the intraday ones for the (company, day) Euronext did not give.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                CREATE MATERIALIZED VIEW IF NOT EXISTS daystocks_intraday
+                WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+                SELECT time_bucket('1 day', date) AS day, cid,
+                       first(value, date) AS open, last(value, date) AS close,
+                       max(value) AS high, min(value) AS low, max(volume) AS volume,
+                       avg(value) AS mean, stddev(value) AS std
+                FROM stocks
+                GROUP BY day, cid
+                WITH NO DATA;
+            """)
+            cursor.execute("""
+                SELECT add_continuous_aggregate_policy('daystocks_intraday',
+                    start_offset => INTERVAL '3 days', end_offset => INTERVAL '1 hour',
+                    schedule_interval => INTERVAL '1 hour', if_not_exists => true);
+            """)
+            cursor.execute("""
+                CREATE OR REPLACE VIEW daystocks_all AS
+                SELECT date, cid, open, close, high, low, volume, mean, std FROM daystocks
+                UNION ALL
+                SELECT i.day, i.cid, i.open, i.close, i.high, i.low, i.volume, i.mean::FLOAT4, i.std::FLOAT4
+                FROM daystocks_intraday i
+                WHERE NOT EXISTS (SELECT 1 FROM daystocks d WHERE d.cid = i.cid AND d.date = i.day);
+            """)
+            self.connection.commit()
+        except Exception as e:
+            print(f"Error creating daystocks views: {e}")
+            self.connection.rollback()  # Rollback the current transaction
+
     def _insert_data(self, table_name, data, commit=False):
         """Insert data into a table in the database."""
         cursor = self.connection.cursor()
@@ -282,9 +518,9 @@ class TimescaleStockMarketModel:
                 self._create_hypertable("stocks", "date")
                 self._create_hypertable("daystocks", "date")
 
-                # Create indexes
-                self._create_index("stocks", "idx_cid_stocks", "cid, date DESC")
-                self._create_index("daystocks", "idx_cid_daystocks", "cid, date DESC")
+                # Create indexes, unique so that loads can merge rows (see copy_merge in the ETL)
+                self._create_index("stocks", "idx_cid_stocks", "cid, date DESC", unique=True)
+                self._create_index("daystocks", "idx_cid_daystocks", "cid, date DESC", unique=True)
 
                 # Insert initial market data
                 self._insert_data("markets", initial_markets_data)
@@ -292,8 +528,12 @@ class TimescaleStockMarketModel:
         except Exception as e:
             self.logger.exception("SQL error: %s" % e)
             self.connection.rollback()
+        # after the tables, also for databases created before these views
+        self._create_daystocks_views()
 
     def _purge_database(self):
+        self._drop_view("daystocks_all")
+        self._drop_view("daystocks_intraday", materialized=True)
         self._drop_table("markets")
         self._drop_table("companies")
         self._drop_table("stocks")
@@ -311,6 +551,52 @@ class TimescaleStockMarketModel:
 
     # ------------------------------ public methods --------------------------------
 
+    @contextlib.contextmanager
+    def checkout(self):
+        """Borrow a connection of the pool for the with block.
+
+        Each request gets its own connection and transaction: what is not
+        committed is rolled back when the connection goes back to the pool, and
+        an error only rolls back this connection.
+        """
+        start = time.perf_counter()
+        try:
+            connection = self.__engine.raw_connection()
+        except sqlalchemy.exc.TimeoutError:
+            self._count_wait(time.perf_counter() - start, timeout=True)
+            raise
+        self._count_wait(time.perf_counter() - start)
+        try:
+            yield connection
+        except Exception:
+            try:
+                connection.rollback()
+            except Exception:  # lost connection, the pool opens another one
+                connection.invalidate()
+            raise
+        finally:
+            connection.close()
+
+    def _count_wait(self, seconds, timeout=False):
+        with self.__pool_lock:
+            waits = self.__pool_waits
+            waits["checkouts"] += 1
+            waits["timeouts"] += timeout
+            waits["wait_total"] += seconds
+            waits["wait_max"] = max(waits["wait_max"], seconds)
+        if timeout or seconds > 1:
+            self.logger.warning(f"pool: waited {seconds:.2f} s for a connection ({self.__engine.pool.status()})")
+
+    def pool_stats(self):
+        """Connections of the pool and time waited for them since the start"""
+        pool = self.__engine.pool
+        with self.__pool_lock:
+            stats = dict(self.__pool_waits)
+        stats["wait_mean"] = stats["wait_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        stats.update(size=pool.size(), checked_out=pool.checkedout(), idle=pool.checkedin(),
+                     overflow=pool.overflow())
+        return stats
+
     def execute(self, query, args=None, cursor=None, commit=False):
         """Send a Postgres SQL command. No return"""
         if args is None:
@@ -318,17 +604,18 @@ class TimescaleStockMarketModel:
         else:
             pretty = '%s %% %r' % (query, args)
         self.logger.debug('SQL: QUERY: %s' % pretty)
-        if cursor is None:
-            cursor = self.connection.cursor()
         try:
-            cursor.execute(query, args)
-            if commit:
-                self.commit()
-            return cursor.fetchall()
+            if cursor is not None:  # connection of the caller
+                cursor.execute(query, args)
+                return cursor.fetchall()
+            with self.checkout() as connection:
+                cursor = connection.cursor()
+                cursor.execute(query, args)
+                if commit:
+                    connection.commit()
+                return cursor.fetchall()
         except Exception as e:
             self.logger.error(f"Exception with execute: {e}")
-            if self.connection:
-                self.connection.rollback()
 
 
     def df_write(self, df, table, args=None, commit=False, if_exists="append", 
@@ -363,44 +650,177 @@ class TimescaleStockMarketModel:
         else:
             pretty = '%s %% %r' % (query, args)
         self.logger.debug('SQL: QUERY: %s' % pretty)
-        if cursor is None:
-            cursor = self.connection.cursor()
+        select = query.strip().upper().startswith('SELECT')
         try:
-            cursor.execute(query, args)
-            query = query.strip().upper()
-            if query.startswith('SELECT'):
-                return cursor.fetchall()
+            if cursor is not None:  # connection of the caller
+                cursor.execute(query, args)
+                return cursor.fetchall() if select else None
+            with self.checkout() as connection:
+                cursor = connection.cursor()
+                cursor.execute(query, args)
+                if select:
+                    return cursor.fetchall()
+                connection.commit()
         except Exception as e:
             self.logger.error(f"Exception with raw_query: {e}")
-            if self.connection:
-                self.connection.rollback()
+
+    def _timezone(self, connection):
+        """TimeZone of the session of a connection of the pool, kept with the connection"""
+        if "timezone" not in connection.info:
+            cursor = connection.cursor()
+            cursor.execute("SELECT current_setting('TimeZone')")
+            connection.info["timezone"] = cursor.fetchone()[0]
+        return connection.info["timezone"]
+
+    def _execute_prepared(self, connection, cursor, query, args):
+        """Run query with args through a statement prepared on the server.
+
+        The statement is prepared the first time a connection of the pool sees
+        the query, later calls only send EXECUTE with the arguments, so Postgres
+        neither parses nor plans the query again. The names of the statements
+        are kept in the info dictionary of the connection, which follows the
+        connection in the pool.
+        """
+        prepared = connection.info.setdefault("prepared", {})
+        for retry in (False, True):
+            name = prepared.get(query)
+            try:
+                if name is None:
+                    sql, count = _numbered(query)
+                    if count != len(args):
+                        raise ValueError(f"{count} placeholders for {len(args)} arguments")
+                    if len(prepared) >= self.max_prepared:
+                        cursor.execute("DEALLOCATE ALL")
+                        prepared.clear()
+                    name = f"dashboard_{len(prepared)}"
+                    cursor.execute(f"PREPARE {name} AS {sql}")
+                    prepared[query] = name
+                # the arguments are quoted by psycopg2, never formatted in the query
+                cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(args))})", args)
+                return
+            except psycopg2.errors.InvalidSqlStatementName:
+                # forgotten by the server (DISCARD ALL...), prepare it again
+                if retry:
+                    raise
+                connection.rollback()
+                prepared.clear()
 
     def df_query(self, query, args=None, index_col=None, coerce_float=True, params=None, 
                  parse_dates=None, columns=None, chunksize=None, dtype=None):
         '''Returns a Pandas dataframe from a Postgres SQL query
 
-        :param query:
-        :param args: arguments for the query
+        :param query: query with %s where the arguments go, e.g. "WHERE cid = %s"
+                      or "WHERE cid = ANY(%s::int[])" with a list
+        :param args: arguments for the query, bound to a prepared statement
+                     (cf _execute_prepared), params is the same
         :param index_col: index column of the DataFrame
         :param other args: see https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.read_sql.html
         :return: a dataframe
         '''
-        if args is not None:
-            query = query % args
+        if args is None:
+            args = params
         self.logger.debug('df_query: %s' % query)
+        if chunksize is not None:  # an iterator of dataframes
+            chunks = self.df_stream(query, args, chunksize, coerce_float=coerce_float, parse_dates=parse_dates)
+            if dtype is not None:
+                chunks = (df.astype(dtype) for df in chunks)
+            if index_col is not None:
+                chunks = (df.set_index(index_col) for df in chunks)
+            return chunks
         try:
-            res = pd.read_sql(query, self.__engine, index_col=index_col, coerce_float=coerce_float, 
-                           params=params, parse_dates=parse_dates, columns=columns, 
-                           chunksize=chunksize, dtype=dtype)
+            with self.checkout() as connection:
+                timezone = self._timezone(connection)
+                cursor = connection.cursor()
+                if args:
+                    self._execute_prepared(connection, cursor, query, tuple(args))
+                else:
+                    cursor.execute(query)
+                if cursor.description is None:  # a command from the SQL tab
+                    connection.commit()
+                    return pd.DataFrame()
+                res = _frame(cursor.fetchall(), [c.name for c in cursor.description],
+                             coerce_float, parse_dates, timezone)
+            if dtype is not None:
+                res = res.astype(dtype)
+            if index_col is not None:
+                res = res.set_index(index_col)
         except Exception as e:
             self.logger.error(e)
             res = pd.DataFrame()
         return res
 
+    def df_stream(self, query, args=None, chunksize=50000, arrow=False, coerce_float=True, parse_dates=None):
+        '''Yield the result of a Postgres SQL query by chunks of chunksize rows at most
+
+        The rows stay on the server in a named cursor and are fetched a chunk at a
+        time, so memory only holds one chunk whatever the size of the result. The
+        connection is kept until the iteration ends or the generator is closed.
+        Like df_query, an error is logged and ends the iteration.
+
+        :param query: a SELECT with %s where the arguments go, as in df_query
+        :param args: arguments for the query, quoted by psycopg2
+        :param arrow: yield pyarrow RecordBatch instead of dataframes
+        :param other args: see df_query
+        '''
+        if arrow and pa is None:
+            raise ImportError("pyarrow is needed for arrow=True")
+        self.logger.debug('df_stream: %s' % query)
+        try:
+            with self.checkout() as connection:
+                timezone = self._timezone(connection)
+                with connection.cursor(f"dashboard_stream_{next(_cursor_names)}") as cursor:
+                    cursor.itersize = chunksize
+                    cursor.execute(query, args)
+                    while True:
+                        rows = cursor.fetchmany(chunksize)
+                        if not rows:
+                            break
+                        df = _frame(rows, [c.name for c in cursor.description], coerce_float, parse_dates,
+                                    timezone)
+                        yield pa.RecordBatch.from_pandas(df, preserve_index=False) if arrow else df
+        except Exception as e:
+            self.logger.error(e)
+
+    def np_query(self, query, args=None):
+        '''Return the columns of a Postgres SQL query as numpy arrays, {name: array}
+
+        The rows are sent by COPY (query) TO STDOUT in binary format and each
+        column is read at once from the bytes received (cf _decode_copy), with no
+        Python object per row: real -> float32, smallint -> int16, timestamptz ->
+        datetime64[us], date -> datetime64[D]. Timestamptz are the times of the
+        session TimeZone, the ones df_query gives, without the time zone. The
+        types come from the description of the query with LIMIT 0, other types
+        than the ones of _COPY_TYPES and text must be cast in the query.
+        Like df_query, an error is logged and gives an empty dictionary.
+
+        :param query: a SELECT with %s where the arguments go, as in df_query
+        :param args: arguments for the query, quoted by psycopg2 (COPY has no parameters)
+        '''
+        self.logger.debug('np_query: %s' % query)
+        try:
+            with self.checkout() as connection:
+                timezone = self._timezone(connection)
+                cursor = connection.cursor()
+                query = cursor.mogrify(query.strip().rstrip(';'), args).decode()
+                cursor.execute(f"SELECT * FROM ({query}) AS q LIMIT 0")
+                names = [c.name for c in cursor.description]
+                oids = [c.type_code for c in cursor.description]
+                unknown = [n for n, oid in zip(names, oids) if oid not in _COPY_TYPES and oid not in _TEXT_TYPES]
+                if unknown:
+                    raise ValueError(f"np_query cannot read {', '.join(unknown)}, cast them in the query")
+                buffer = io.BytesIO()
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT binary)", buffer)
+            columns = _decode_copy(buffer.getbuffer(), oids)
+        except Exception as e:
+            self.logger.error(e)
+            return {}
+        return {name: _wall_clock(column, timezone) if oid == 1184 else column
+                for name, oid, column in zip(names, oids, columns)}
+
     # system methods
 
     def commit(self):
-        if not self.__squash:
+        if not self.__squash and self.connection is not None:
             self.connection.commit()
 
             
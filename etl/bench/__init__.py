@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Banc d'essai de l'ETL.
+
+  generate écrit des fichiers synthétiques aux formats que lit etl.py
+  (pickles bz2 Boursorama, csv et xlsx Euronext) et __main__ mesure le débit
+  et la mémoire de chaque étape. Depuis le dossier etl :
+
+      python -m bench --companies 500 --days 20 --snapshots 50
+'''
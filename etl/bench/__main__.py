@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Mesure du débit (lignes/s, Mo/s) et du pic mémoire de chaque étape de l'ETL
+  sur des données synthétiques.
+
+  Chaque étape est passée deux fois : une fois chronométrée, une fois sous
+  tracemalloc (qui ralentit pandas) pour le pic mémoire d'un appel.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import etl
+import timescaledb_model as tsdb
+from bench.generate import generate
+from companies import SymbolIndex
+
+
+def measure(name, func, items, prepare=lambda item: item, size=lambda item: 0):
+    """Run func(prepare(item)) for all items, only func is measured.
+
+    func returns the number of rows it produced or handled, size(item) the
+    number of bytes read for an item.
+    """
+    rows = 0
+    nbytes = 0
+    seconds = 0.0
+    for item in items:
+        arg = prepare(item)
+        start = time.perf_counter()
+        rows += func(arg)
+        seconds += time.perf_counter() - start
+        nbytes += size(item)
+
+    peak = 0
+    tracemalloc.start()
+    for item in items:
+        arg = prepare(item)
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func(arg)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        del arg
+    tracemalloc.stop()
+
+    return {
+        "stage": name,
+        "files": len(items),
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rows_per_s": round(rows / seconds) if seconds else None,
+        "mb_per_s": round(nbytes / seconds / 1e6, 2) if seconds and nbytes else None,
+        "peak_mb": round(peak / 1e6, 2),
+    }
+
+
+def measure_xlsx(paths, size):
+    """read_euronext of xlsx files, parsed (cold cache) then read from the Parquet cache"""
+    saved = etl.CACHE
+    root = tempfile.mkdtemp(prefix="etl_bench_cache_")
+    try:
+        def cold(path):
+            # a new cache folder for each call of both passes: the xlsx is always parsed
+            etl.CACHE = tempfile.mkdtemp(dir=root)
+            return path
+
+        results = [measure("read_euronext[xlsx parse (cold)]", lambda p: len(etl.read_euronext(p)),
+                           paths, prepare=cold, size=size)]
+        etl.CACHE = os.path.join(root, "warm")
+        for path in paths:
+            etl.read_euronext(path)
+        results.append(measure("read_euronext[xlsx cached read]", lambda p: len(etl.read_euronext(p)),
+                               paths, size=size))
+        return results
+    finally:
+        etl.CACHE = saved
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def run(home, companies, db=None):
+    markets = pd.DataFrame(tsdb.initial_markets_data,
+                           columns=["id", "name", "alias", "boursorama", "sws", "euronext"])
+    keys = companies["prefix"] + companies["symbol"]
+    symbol_index = SymbolIndex(keys, range(1, len(keys) + 1))
+    manifest = etl.build_manifest(home)
+    bourso = [p for files in manifest["boursorama"].values() for p in files]
+    euronext = list(manifest["euronext"].values())
+    file_size = os.path.getsize
+
+    results = [
+        measure("read_boursorama", lambda p: len(etl.read_boursorama(p)), bourso, size=file_size),
+        measure("insert_boursorama", lambda a: len(etl.insert_boursorama(a[1], None, a[0], symbol_index)),
+                bourso, prepare=lambda p: (p, etl.read_boursorama(p))),
+    ]
+    for ext in ("csv", "xlsx"):
+        paths = [p for p in euronext if p.endswith(ext)]
+        if not paths:
+            continue
+        if ext == "csv":
+            results.append(measure("read_euronext[csv]", lambda p: len(etl.read_euronext(p)), paths, size=file_size))
+        else:
+            results.extend(measure_xlsx(paths, file_size))
+        results.append(measure(f"transform_euronext[{ext}]",
+                               lambda a: len(etl.transform_euronext(a[1], a[0], markets)[1]),
+                               paths, prepare=lambda p: (p, etl.read_euronext(p))))
+
+    if db is not None:
+        frames = [etl.insert_boursorama(etl.read_boursorama(p), None, p, symbol_index) for p in bourso]
+        # raw_query, execute would fetch the rows of a command and roll it back
+        db.raw_query("CREATE TEMP TABLE IF NOT EXISTS bench_stocks (LIKE stocks)")
+        db.commit()
+
+        def write(batch):
+            db.copy_write(batch, "bench_stocks")
+            db.raw_query("TRUNCATE bench_stocks")
+            db.commit()
+            return sum(len(f) for f in batch)
+
+        results.append(measure("copy_write[stocks]", write, [frames]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the ETL stages on synthetic data")
+    parser.add_argument("--companies", type=int, default=200)
+    parser.add_argument("--days", type=int, default=5)
+    parser.add_argument("--snapshots", type=int, default=20, help="Boursorama snapshots per day")
+    parser.add_argument("--start", default="2020-01-06", help="first day generated")
+    parser.add_argument("--xlsx-every", type=int, default=5, help="one Euronext day in N is xlsx, 0 for none")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data", help="folder for the generated files, kept; a temporary one otherwise")
+    parser.add_argument("--json", help="write the results in this file, one JSON object per line")
+    parser.add_argument("--database", help="measure copy_write in this database (temporary table only)")
+    parser.add_argument("--user")
+    parser.add_argument("--host")
+    parser.add_argument("--password")
+    args = parser.parse_args()
+
+    home = args.data or tempfile.mkdtemp(prefix="etl_bench_")
+    etl.HOME = home
+    try:
+        start = time.perf_counter()
+        companies, bourso, euronext = generate(home, args.companies, args.days, args.snapshots,
+                                               args.start, args.xlsx_every, args.seed)
+        print(f"{len(bourso)} Boursorama and {len(euronext)} Euronext files generated "
+              f"in {time.perf_counter() - start:.1f} s in {home}")
+
+        db = None
+        if args.database:
+            # no setup: the bench only writes in its temporary table
+            db = tsdb.TimescaleStockMarketModel(args.database, args.user, args.host, args.password, setup=False)
+        results = run(home, companies, db)
+    finally:
+        if not args.data:
+            shutil.rmtree(home, ignore_errors=True)
+
+    print(f"{'stage':32} {'files':>6} {'rows':>10} {'seconds':>9} {'rows/s':>11} {'MB/s':>8} {'peak MB':>8}")
+    for r in results:
+        print(f"{r['stage']:32} {r['files']:>6} {r['rows']:>10} {r['seconds']:>9} "
+              f"{r['rows_per_s'] or '-':>11} {r['mb_per_s'] or '-':>8} {r['peak_mb']:>8}")
+    if args.json:
+        with open(args.json, "a") as f:
+            for r in results:
+                f.write(json.dumps({**r, "companies": args.companies, "days": args.days,
+                                    "snapshots": args.snapshots}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Génération de fichiers synthétiques pour le banc d'essai.
+
+  Les noms et les formats sont ceux des vrais fichiers :
+    boursorama/<année>/compX YYYY-MM-DD HH:MM:SS.ffffff.bz2   pickle bz2 (symbol, name, last, volume)
+    euronext/Euronext_Equities_YYYY-MM-DD.csv                  tabulations, 3 lignes après l'en-tête
+    euronext/Euronext_Equities_YYYY-MM-DD.xlsx                 mêmes lignes, noms de colonnes xlsx
+'''
+
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# (Euronext market, Boursorama prefix) of the markets the ETL knows
+MARKETS = (
+    ("Euronext Paris", "1rP"),
+    ("Euronext Brussels", "FF11_"),
+    ("Euronext Amsterdam", "1rA"),
+    ("Euronext Paris, Euronext Brussels", "1rP"),
+)
+
+EURONEXT_CSV_HEADER = ["Name", "ISIN", "Symbol", "Market", "Currency", "Open", "High", "Low", "Last",
+                       "Last Date/Time", "Time Zone", "Volume", "Turnover"]
+EURONEXT_XLSX_HEADER = ["Name", "ISIN", "Symbol", "Market", "Currency", "Open Price", "High Price",
+                        "low Price", "last Price", "Last Date/Time", "Time Zone", "Volume", "Turnover"]
+
+
+def make_companies(n, rng):
+    """Return a DataFrame of n companies with name, isin, symbol, market, boursorama prefix and base price"""
+    markets = rng.integers(0, len(MARKETS), n)
+    return pd.DataFrame({
+        "name": [f"COMPANY {i:05d}" for i in range(n)],
+        "isin": [f"FR{i:010d}" for i in range(n)],
+        "symbol": [f"S{i:04X}" for i in range(n)],
+        "market": [MARKETS[m][0] for m in markets],
+        "prefix": [MARKETS[m][1] for m in markets],
+        "price": rng.lognormal(3, 1, n).round(2),
+    })
+
+
+def _format_price(values, suffixes):
+    """Boursorama style prices: decimal comma, thousands space, sometimes (c) or (s)"""
+    text = [f"{v:,.2f}".replace(",", " ").replace(".", ",") for v in values]
+    return [t + s for t, s in zip(text, suffixes)]
+
+
+def write_boursorama(home, companies, day, snapshots, rng, groups=2):
+    """Write the snapshots of a day, the companies are split in groups (compA, compB, ...)"""
+    folder = os.path.join(home, "boursorama", str(day.year))
+    os.makedirs(folder, exist_ok=True)
+    opening = datetime(day.year, day.month, day.day, 9, 0)
+    step = timedelta(seconds=8.5 * 3600 / max(snapshots, 1))
+    volume = np.zeros(len(companies))
+    price = companies["price"].to_numpy()
+    paths = []
+    for s in range(snapshots):
+        time = opening + s * step + timedelta(microseconds=int(rng.integers(0, 999999)))
+        price = (price * rng.normal(1, 0.002, len(price))).round(2)
+        volume = volume + rng.integers(0, 1000, len(price)) * (rng.random(len(price)) < 0.7)
+        suffixes = rng.choice(["", "(c)", "(s)"], len(price), p=[0.9, 0.07, 0.03])
+        for g, rows in enumerate(np.array_split(np.arange(len(companies)), groups)):
+            df = pd.DataFrame({
+                "symbol": (companies["prefix"] + companies["symbol"]).to_numpy()[rows],
+                "name": companies["name"].to_numpy()[rows],
+                "last": _format_price(price[rows], suffixes[rows]),
+                "volume": volume[rows].astype("int64"),
+            })
+            path = os.path.join(folder, f"comp{chr(ord('A') + g)} {time.strftime('%Y-%m-%d %H:%M:%S.%f')}.bz2")
+            df.to_pickle(path, compression="bz2")
+            paths.append(path)
+    return paths
+
+
+def write_euronext(home, companies, day, rng, xlsx=False):
+    """Write the Euronext file of a day, as csv or as xlsx"""
+    folder = os.path.join(home, "euronext")
+    os.makedirs(folder, exist_ok=True)
+    n = len(companies)
+    close = companies["price"].to_numpy() * rng.normal(1, 0.01, n)
+    open_ = close * rng.normal(1, 0.01, n)
+    high = np.maximum(open_, close) * (1 + rng.random(n) * 0.01)
+    low = np.minimum(open_, close) * (1 - rng.random(n) * 0.01)
+    volume = rng.integers(0, 100000, n)
+    rows = pd.DataFrame({
+        "Name": companies["name"], "ISIN": companies["isin"], "Symbol": companies["symbol"],
+        "Market": companies["market"], "Currency": "EUR",
+        "Open": open_.round(2), "High": high.round(2), "Low": low.round(2), "Last": close.round(2),
+        "Last Date/Time": day.strftime("%d/%m/%Y 17:35"), "Time Zone": "CET",
+        "Volume": volume, "Turnover": (volume * close).round(0),
+    }).astype(object)
+    no_trade = rng.random(n) < 0.05
+    rows.loc[no_trade, ["Open", "High", "Low", "Last", "Volume", "Turnover"]] = "-"
+
+    junk = [["European Equities"] + [""] * 12, [day.strftime("%d %b %Y")] + [""] * 12,
+            ["All data - 15 minutes delay"] + [""] * 12]
+    if xlsx:
+        path = os.path.join(folder, f"Euronext_Equities_{day.isoformat()}.xlsx")
+        table = pd.DataFrame([EURONEXT_XLSX_HEADER] + junk + rows.values.tolist())
+        table.to_excel(path, header=False, index=False)
+    else:
+        path = os.path.join(folder, f"Euronext_Equities_{day.isoformat()}.csv")
+        with open(path, "w") as f:
+            f.write("\t".join(EURONEXT_CSV_HEADER) + "\n")
+            for line in junk:
+                f.write("\t".join(line) + "\n")
+            rows.to_csv(f, sep="\t", header=False, index=False)
+    return path
+
+
+def generate(home, companies=200, days=5, snapshots=20, start="2020-01-06", xlsx_every=5, seed=0):
+    """Write companies x days x snapshots of synthetic data under home.
+
+    Every xlsx_every-th day is written as xlsx instead of csv (0 for never).
+    Returns (companies, boursorama paths, euronext paths).
+    """
+    rng = np.random.default_rng(seed)
+    table = make_companies(companies, rng)
+    day = datetime.strptime(start, "%Y-%m-%d").date()
+    boursorama, euronext = [], []
+    for d in range(days):
+        xlsx = bool(xlsx_every) and d % xlsx_every == xlsx_every - 1
+        euronext.append(write_euronext(home, table, day, rng, xlsx))
+        boursorama.extend(write_boursorama(home, table, day, snapshots, rng))
+        day += timedelta(days=1)
+    return table, boursorama, euronext
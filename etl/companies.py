@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Registre des entreprises pour l'ETL.
+
+  La table companies est lue une seule fois par exécution, ensuite un couple
+  (name, euronext) est résolu en id par une recherche dans un dictionnaire et
+  seules les nouvelles entreprises sont écrites dans la base.
+
+  Plusieurs processus peuvent charger des mois différents en même temps :
+  l'écriture des entreprises se fait sous un verrou consultatif (advisory lock)
+  pour qu'une entreprise ne soit pas créée deux fois avec deux ids.
+
+  Côté Boursorama, SymbolIndex donne l'id des sociétés d'une colonne de
+  symboles et UnmatchedSymbols compte les symboles sans société.
+'''
+
+import numpy as np
+import pandas as pd
+
+
+class CompanyRegistry:
+    """ Companies of the database indexed by (name, euronext)."""
+
+    def __init__(self, db):
+        """Load the companies table
+
+        db -- a TimescaleStockMarketModel
+        """
+        self.db = db
+        companies = db.df_query("SELECT id, name, euronext FROM companies")
+        if companies.empty:
+            self.ids = {}
+        else:
+            self.ids = dict(zip(zip(companies['name'], companies['euronext']), companies['id']))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, companies):
+        """Write the companies which are not known yet, return how many were added
+
+        Ids are taken from company_id_seq in one query and written with the rows,
+        so the registry does not have to read the table back. The transaction
+        holds an advisory lock until its commit, the companies another process
+        wrote in the meantime are read instead of being created again.
+
+        Raises RuntimeError when the database does not answer: the ids come from
+        the database, the companies cannot wait in the spool.
+        """
+        keys = zip(companies['name'], companies['euronext'])
+        new = companies[[key not in self.ids for key in keys]]
+        new = new.drop_duplicates(['name', 'euronext'])
+        if new.empty:
+            return 0
+
+        # raw_query logs its errors and returns None
+        if self.db.raw_query("SELECT pg_advisory_xact_lock(hashtext('companies'))") is None:
+            raise RuntimeError("companies: lock not taken, database unreachable?")
+        rows = self.db.raw_query("SELECT id, name, euronext FROM companies WHERE name = ANY(%s)",
+                                 (list(new['name']),))
+        if rows is None:
+            raise RuntimeError("companies: table not read, database unreachable?")
+        self.ids.update(((name, euronext), id) for id, name, euronext in rows)
+        new = new[[key not in self.ids for key in zip(new['name'], new['euronext'])]]
+        if new.empty:
+            self.db.commit()  # releases the lock
+            return 0
+
+        ids = self.db.raw_query("SELECT nextval('company_id_seq') FROM generate_series(1, %s)", (len(new),))
+        if ids is None:
+            raise RuntimeError("companies: no ids, database unreachable?")
+        new = new.drop(columns=['id'], errors='ignore')
+        new.insert(0, 'id', [row[0] for row in ids])
+        # not spooled: written in the transaction of the lock, the error goes to the caller
+        self.db.df_write(new, 'companies', spool=False)
+        self.ids.update(zip(zip(new['name'], new['euronext']), new['id']))
+        return len(new)
+
+    def resolve(self, names, euronexts):
+        """Return the ids of the (name, euronext) couples, NA for unknown companies"""
+        return pd.array([self.ids.get(key) for key in zip(names, euronexts)], dtype="Int64")
+
+
+def create_keys(boursorama, symbol):
+    """Vectorized etl.create_key: Boursorama symbols of the companies.
+
+    The symbol replaces the * of the Boursorama prefix (1u*.L), or follows it.
+    NA for the companies without Boursorama prefix.
+    """
+    before, star, after = (boursorama.astype("string").str.partition("*")[i] for i in range(3))
+    return before + symbol.astype("string") + after
+
+
+class SymbolIndex:
+    """Company ids of the Boursorama symbols.
+
+    Built once per run and sent once to each worker, a column of symbols is
+    resolved by one get_indexer on the hash table of the index.
+    """
+
+    def __init__(self, keys, ids):
+        keys = pd.Index(keys)
+        ids = np.asarray(ids)
+        keep = np.asarray(keys.notna() & ~keys.duplicated(keep="last"))  # as a dict would
+        self.keys = keys[keep]
+        self.ids = ids[keep]
+
+    @classmethod
+    def from_companies(cls, companies):
+        """Index of a frame of the companies table"""
+        return cls(create_keys(companies['boursorama'], companies['symbol']), companies['id'].to_numpy())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, symbols):
+        """Return (ids, found) numpy arrays for a column of symbols, ids are 0 where not found
+
+        >>> SymbolIndex(["1rPAI", "1rPOR"], [3, 7]).lookup(["1rPOR", "XX", "1rPAI"])
+        (array([7, 0, 3]), array([ True, False,  True]))
+        >>> SymbolIndex([], []).lookup(["1rPAI", "XX"])  # no company yet
+        (array([0, 0]), array([False, False]))
+        """
+        positions = self.keys.get_indexer(symbols)
+        found = positions >= 0
+        ids = np.zeros(len(positions), dtype=self.ids.dtype if len(self.ids) else np.int64)
+        ids[found] = self.ids[positions[found]]
+        return ids, found
+
+
+class UnmatchedSymbols:
+    """Boursorama symbols without company met during a run, with their rows and dates."""
+
+    def __init__(self):
+        self.symbols = {}  # symbol -> [rows, first date, last date]
+
+    def __len__(self):
+        return len(self.symbols)
+
+    @property
+    def rows(self):
+        return sum(seen[0] for seen in self.symbols.values())
+
+    def _merge(self, symbol, rows, first, last):
+        seen = self.symbols.get(symbol)
+        if seen is None:
+            self.symbols[symbol] = [rows, first, last]
+        else:
+            seen[0] += rows
+            seen[1] = min(seen[1], first)
+            seen[2] = max(seen[2], last)
+
+    def add(self, symbols, dates):
+        """Count rows of symbols, dates is a date or a column of dates of the same length"""
+        if isinstance(dates, pd.Series):
+            dates = dates.to_numpy()
+        frame = pd.DataFrame({"symbol": np.asarray(symbols, dtype=object), "date": dates})
+        stats = frame.groupby("symbol")["date"].agg(["size", "min", "max"])
+        for symbol, rows, first, last in stats.itertuples():
+            self._merge(symbol, int(rows), first, last)
+
+    def update(self, other):
+        """Add the symbols of another UnmatchedSymbols, from a worker"""
+        for symbol, (rows, first, last) in other.symbols.items():
+            self._merge(symbol, rows, first, last)
+
+    def report(self, top=10):
+        """One line summary with the most frequent symbols"""
+        frequent = sorted(self.symbols.items(), key=lambda item: -item[1][0])[:top]
+        return (f"{len(self)} symboles Boursorama sans société, {self.rows} lignes ignorées : "
+                + ", ".join(f"{symbol} ({seen[0]})" for symbol, seen in frequent))
+
+    def table_rows(self):
+        """(symbol, rows, first date, last date) rows of the unmatched_symbols table, by symbol"""
+        return [(symbol, rows, pd.Timestamp(first).to_pydatetime(), pd.Timestamp(last).to_pydatetime())
+                for symbol, (rows, first, last) in sorted(self.symbols.items())]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
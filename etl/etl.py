@@ -4,13 +4,33 @@ from datetime import datetime, timedelta
 import sklearn
 from zipfile import ZipFile
 import glob
+import hashlib
+import io
 import time
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import mylogging
 import os
 import timescaledb_model as tsdb
+from companies import CompanyRegistry, SymbolIndex, UnmatchedSymbols
+from metrics import Metrics
+from pipeline import background, batches
+from spool import Spool
+from watch import watcher
 
 TSDB = tsdb.TimescaleStockMarketModel
 HOME = "/home/bourse/data/"   # we expect subdirectories boursorama and euronext
+CACHE = os.environ.get("ETL_CACHE")  # converted files, HOME/cache by default
+
+# colonnes des tables avec le type numpy de leur type Postgres : les transformations
+# produisent directement ces types, que l'encodeur COPY binaire écrit sans conversion
+STOCKS_DTYPES = {"date": "datetime64[us]", "cid": "int16", "value": "float32", "volume": "float32"}
+DAYSTOCKS_DTYPES = {"date": "datetime64[us]", "cid": "int16", "open": "float32", "close": "float32",
+                    "high": "float32", "low": "float32", "volume": "float32", "mean": "float32", "std": "float32"}
 
 #=================================================
 # Extract, Transform and Load data in the database
@@ -20,20 +40,6 @@ HOME = "/home/bourse/data/"   # we expect subdirectories boursorama and euronext
 # private functions
 # 
 
-#
-# decorator
-# 
-
-def timer_decorator(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        print(f"{func.__name__} run in {(end_time - start_time):.2f} seconds.")
-        return result
-
-    return wrapper
-
 #
 # public functions
 # 
@@ -45,7 +51,10 @@ def daterange(start_date, end_date):
         yield current_date
         current_date += timedelta(days=1)
 
-def find_boursorama(date):
+def find_boursorama(date, manifest=None):
+    if manifest is not None:
+        return manifest["boursorama"].get(date)
+
     d = date.strftime("%Y-%m-%d")
     base_path = os.path.join(HOME, "boursorama")
     matching_files = []
@@ -62,15 +71,21 @@ def find_boursorama(date):
 
     return matching_files
 
-def read_boursorama(path):
+def read_boursorama(path, data=None):
+    """Unpickle a Boursorama file, from data (its content) if already read"""
     try:
+        if data is not None:
+            return pd.read_pickle(io.BytesIO(data), compression="bz2" if path.endswith(".bz2") else None)
         df = pd.read_pickle(path)
         return df
     except Exception as e:
         return None
 
 
-def find_euronext(date):
+def find_euronext(date, manifest=None):
+    if manifest is not None:
+        return manifest["euronext"].get(date)
+
     date = date.isoformat()
     path = os.path.join(HOME, "euronext", f"Euronext_Equities_{date}.csv")
     if not os.path.exists(path):
@@ -80,14 +95,109 @@ def find_euronext(date):
             return None
     return path
 
+# Column of each Euronext file format -> name used by the ETL
+EURONEXT_FORMATS = {
+    "csv": {
+        "Name": "name", "Symbol": "symbol", "ISIN": "isin", "Market": "market",
+        "Open": "open", "High": "high", "Low": "low", "Last": "close",
+        "Volume": "volume", "Turnover": "turnover",
+    },
+    "xlsx": {
+        "Name": "name", "Symbol": "symbol", "ISIN": "isin", "Market": "market",
+        "Open Price": "open", "High Price": "high", "low Price": "low", "last Price": "close",
+        "Volume": "volume", "Turnover": "turnover",
+    },
+}
+EURONEXT_NUMERIC = ("open", "high", "low", "close", "volume", "turnover")
+
+try:
+    import pyarrow
+    import pyarrow.csv as pacsv  # faster csv parser, optional
+    import pyarrow.parquet as pq
+except ImportError:
+    pacsv = pq = None
+
+def _read_euronext_csv(path, columns, numeric):
+    if pacsv is not None:
+        try:
+            table = pacsv.read_csv(
+                path,
+                read_options=pacsv.ReadOptions(skip_rows_after_names=3),
+                parse_options=pacsv.ParseOptions(delimiter='\t'),
+                convert_options=pacsv.ConvertOptions(
+                    include_columns=list(columns),
+                    column_types={c: pyarrow.float64() for c in numeric},
+                    null_values=pacsv.ConvertOptions().null_values + ["-"],
+                    strings_can_be_null=True,
+                ),
+            )
+            return table.to_pandas()
+        except pyarrow.ArrowInvalid:
+            pass  # not a number somewhere, let pandas coerce it
+
+    kwargs = dict(sep='\t', skiprows=[1,2,3], usecols=list(columns), na_values=["-"])
+    try:
+        return pd.read_csv(path, dtype={c: "float64" for c in numeric}, **kwargs)
+    except ValueError:
+        # something else than a number or "-" somewhere, parse as text and coerce as before
+        df = pd.read_csv(path, dtype={c: "object" for c in numeric}, **kwargs)
+        for c in numeric:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+        return df
+
+def cache_dir():
+    return CACHE or os.path.join(HOME, "cache")
+
+def _euronext_cache_path(path):
+    """Parquet copy of an xlsx file, its name changes with the file and EURONEXT_FORMATS"""
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}|{EURONEXT_FORMATS['xlsx']}"
+    stem = os.path.splitext(os.path.basename(path))[0]
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir(), "euronext", f"{stem}-{digest}.parquet")
+
+def _read_euronext_xlsx(path, columns, numeric):
+    """read_excel is slow, so each xlsx file is parsed once and kept as Parquet"""
+    cached = _euronext_cache_path(path) if pacsv is not None else None
+    if cached is not None and os.path.exists(cached):
+        try:
+            return pd.read_parquet(cached)
+        except Exception as e:
+            print(f"Cache {cached} illisible: {e}")
+
+    df = pd.read_excel(path, skiprows=[1,2,3], usecols=list(columns), na_values=["-"])
+    for c in numeric:
+        df[c] = pd.to_numeric(df[c], errors="coerce").astype("float64")
+
+    if cached is not None:
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            stem = os.path.basename(cached).rsplit("-", 1)[0]
+            for old in glob.glob(os.path.join(glob.escape(os.path.dirname(cached)), f"{glob.escape(stem)}-*.parquet")):
+                os.remove(old)  # copies of an older version of the file
+            tmp = f"{cached}.{os.getpid()}.tmp"
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, cached)
+        except OSError as e:
+            print(f"Impossible d'écrire le cache {cached}: {e}")
+    return df
+
 def read_euronext(path):
+    """Read an Euronext csv or xlsx file with the ETL column names.
+
+    Only the columns of EURONEXT_FORMATS are parsed, "-" is NA and the
+    prices, volume and turnover are float64. xlsx files are cached as Parquet
+    in cache_dir() when pyarrow is installed.
+    """
     try:
-        df = pd.DataFrame()
-        if (path.split('.')[-1] == "csv"):
-            df = pd.read_csv(path, sep='\t', skiprows=[1,2,3])
+        ext = path.split('.')[-1]
+        columns = EURONEXT_FORMATS[ext]
+        numeric = [source for source, name in columns.items() if name in EURONEXT_NUMERIC]
+        if ext == "csv":
+            df = _read_euronext_csv(path, columns, numeric)
         else:
-            df = pd.read_excel(path, skiprows=[1,2,3])
-        return df
+            df = _read_euronext_xlsx(path, columns, numeric)
+        return df.rename(columns=columns)
     except Exception as e:
         print(e)
         return None
@@ -112,205 +222,121 @@ def get_euronext(euronext):
         result.append("Paris")
     return result
 
-def insert_euronext_csv(df, db:TSDB, path, existing_markets):
+def transform_euronext(df, path, existing_markets):
+    """Build the companies and daystocks frames of an Euronext file read by read_euronext.
+
+    Does not touch the database so it can run in a worker process.
+    """
+    # Récupération des entreprises
+    companies = pd.DataFrame()
+    companies["name"] = df['name']
+    companies["mid"] = None #stands for Market Id --  m_id -- mid
+    companies["symbol"] = df['symbol']
+    companies["isin"] = df["isin"]
+    companies["euronext"] = df["market"]
+    companies["pea"] = False
+    companies["sector1"] = None
+    companies["sector2"] = None
+    companies["sector3"] = None
+
+    # Récupération des daystocks
+    daystocks = pd.DataFrame()
+
+    daystocks["open"] = df["open"]
+    daystocks["close"] = df["close"]
+    daystocks["high"] = df["high"]
+    daystocks["low"] = df["low"]
+    daystocks["volume"] = df["volume"]
+    daystocks["mean"] = df["turnover"] / daystocks["volume"]
+    daystocks["std"] = daystocks[["open", "high", "low", "close"]].std(axis=1)
+    daystocks["euronext"] = df["market"]
+    daystocks["name"] = df["name"]
+    daystocks["date"] = get_euronext_date(path)
+    daystocks = daystocks.astype({c: t for c, t in DAYSTOCKS_DTYPES.items() if c in daystocks})
+
+    #-------------------------------------------------------------------------------------------
+    # Companies
+
+    companies['market_names'] = companies['euronext'].apply(get_euronext)
+
+    # Mapper les noms vers des IDs
+    market_map = existing_markets.set_index('name')['id'].to_dict()
+    companies['market_ids'] = companies['market_names'].apply(
+        lambda names: [market_map[name] for name in names]
+    )
+
+    # Supprimer les lignes sans marché reconnu (si besoin)
+    companies = companies[companies['market_ids'].map(len) > 0]
+
+    # Dupliquer les lignes : une par marché
+    companies = companies.explode('market_ids')
+    companies['mid'] = companies['market_ids'].astype("Int64")
+
+    companies = companies.drop(columns=['market_names', 'market_ids'])
+
+    market_fields = existing_markets[['id', 'boursorama']].rename(columns={
+        'id': 'mid',
+    })
+    companies = companies.merge(market_fields, on='mid', how='left')
+
+    # Retrouve le bon Euronext en inversant la map
+    id_to_market = {v: k for k, v in market_map.items()}
+
+    # Remplir la colonne euronext avec le nom du marché correspondant à l’ID
+    companies['euronext'] = companies['mid'].map(id_to_market)
+
+    #-------------------------------------------------------------------------------------------
+    # Daystocks
+
+    # Explode for each euronext
+    daystocks['euronext'] = daystocks['euronext'].apply(get_euronext)
+    daystocks = daystocks.explode('euronext')
+
+    return companies, daystocks
+
+def load_euronext(companies, daystocks, db:TSDB, path, registry=None, merge=False, metrics=None):
+    """Write the frames built by transform_euronext, new companies first.
+
+    registry -- CompanyRegistry shared by the files of a run, created here if not given
+    merge    -- replace the daystocks already loaded for these companies and day
+    metrics  -- Metrics of the run, measures the companies and copy stages
+    Returns True when the file is written, or spooled, with its file_done row.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    name = done_name(path)
     try:
-        # Récupération des entreprises
-        companies = pd.DataFrame()
-        companies["name"] = df['Name']
-        companies["mid"] = None #stands for Market Id --  m_id -- mid
-        companies["symbol"] = df['Symbol']
-        companies["isin"] = df["ISIN"]
-        companies["euronext"] = df["Market"]
-        companies["pea"] = False
-        companies["sector1"] = None
-        companies["sector2"] = None
-        companies["sector3"] = None
-
-        # Récupération des daystocks
-        daystocks = pd.DataFrame()
-        
-        daystocks["cid"] = None
-        daystocks["open"] = pd.to_numeric(df["Open"].replace("-", pd.NA), errors="coerce")
-        daystocks["close"] = pd.to_numeric(df["Last"].replace("-", pd.NA), errors="coerce")
-        daystocks["high"] = pd.to_numeric(df["High"].replace("-", pd.NA), errors="coerce")
-        daystocks["low"] = pd.to_numeric(df["Low"].replace("-", pd.NA), errors="coerce")
-        daystocks["volume"] = pd.to_numeric(df["Volume"].replace("-", pd.NA), errors="coerce")
-        daystocks["mean"] = pd.to_numeric(df["Turnover"].replace("-", pd.NA), errors="coerce") / daystocks["volume"]
-        daystocks["std"] = daystocks[["open", "high", "low", "close"]].std(axis=1)
-        daystocks["euronext"] = df["Market"]
-        daystocks["name"] = df["Name"]
-        daystocks["date"] = get_euronext_date(path)
-
-        #-------------------------------------------------------------------------------------------
-        # Adding companies
-
-        companies['market_names'] = companies['euronext'].apply(get_euronext)
-        
-        # Mapper les noms vers des IDs
-        market_map = existing_markets.set_index('name')['id'].to_dict()
-        companies['market_ids'] = companies['market_names'].apply(
-            lambda names: [market_map[name] for name in names]
-        )
-
-        # Supprimer les lignes sans marché reconnu (si besoin)
-        companies = companies[companies['market_ids'].map(len) > 0]
-
-        # Dupliquer les lignes : une par marché
-        companies = companies.explode('market_ids')
-        companies['mid'] = companies['market_ids'].astype("Int64")
-
-        companies = companies.drop(columns=['market_names', 'market_ids'])
-        
-        market_fields = existing_markets[['id', 'boursorama']].rename(columns={
-            'id': 'mid', 
-        })
-        companies = companies.merge(market_fields, on='mid', how='left')
-
-        # Retrouve le bon Euronext en inversant la map
-        id_to_market = {v: k for k, v in market_map.items()}
-
-        # Remplir la colonne euronext avec le nom du marché correspondant à l’ID
-        companies['euronext'] = companies['mid'].map(id_to_market)
-
-        # Insérer uniquement les nouvelles sociétés
-        existing_companies = db.df_query("SELECT name, euronext FROM companies")
-
-        # Filtre les nouvelles sociétés basées sur (name, euronext)
-        companies = companies[~companies[['name', 'euronext']].apply(tuple, axis=1).isin(
-            existing_companies[['name', 'euronext']].apply(tuple, axis=1))]
-        
-        if not companies.empty:
-            try:
-                db.df_write(companies, 'companies')
-            except Exception as e:
-                print("Erreur lors de l'insertion des companies:", e)
-
-        #-------------------------------------------------------------------------------------------
-        # Adding daystocks
+        with metrics.stage("companies", name) as record:
+            if registry is None:
+                registry = CompanyRegistry(db)
 
-        # Explode for each euronext
-        daystocks['euronext'] = daystocks['euronext'].apply(get_euronext)
-        daystocks = daystocks.explode('euronext')
+            # Insérer uniquement les nouvelles sociétés. En cas d'échec le fichier
+            # n'est pas chargé (ni marqué fait) plutôt que chargé sans ses sociétés
+            record["rows"] = registry.add(companies)
 
-        company_id = db.df_query("SELECT id, name, euronext FROM companies")
+            daystocks['cid'] = registry.resolve(daystocks['name'], daystocks['euronext'])
+        daystocks = daystocks.drop_duplicates(['cid', 'date'], keep='last') # (cid, date) est unique dans la base
 
-        company_id_map = company_id.set_index(['name', 'euronext'])['id'].to_dict()
-        daystocks['cid'] = list(zip(daystocks['name'], daystocks['euronext']))
-        daystocks['cid'] = daystocks['cid'].map(company_id_map)
-        daystocks["cid"] = daystocks["cid"].astype("Int64")
-
-        daystocks.drop(columns=["euronext", "name"], inplace=True)
-
-        if not daystocks.empty and daystocks["cid"].notna().all():
+        if daystocks.empty:
+            return db.mark_files_done([name])
+        elif daystocks["cid"].notna().all():
+            daystocks = daystocks[list(DAYSTOCKS_DTYPES)].astype(DAYSTOCKS_DTYPES)
             try:
-                db.df_write(daystocks, 'daystocks')
+                with metrics.stage("copy", name) as record:
+                    record["rows"] = len(daystocks)
+                    record["bytes"] = int(daystocks.memory_usage(index=False).sum())
+                    db.df_write(daystocks, 'daystocks', done=[name], merge=merge)
+                return True
             except Exception as e:
                 print("Erreur lors de l'insertion des stocks jounaliers:", e)
-
-        print(path, " indexé")
     except Exception as e:
             print(f"Erreur SQL avec {path}: {e}")
             #db.connection.rollback()
+    return False
 
-def insert_euronext_xlsx(df, db:TSDB, path, existing_markets):
-    try:
-        
-        # Récupération des entreprises
-        companies = pd.DataFrame()
-        companies["name"] = df['Name']
-        companies["mid"] = None #stands for Market Id --  m_id -- mid
-        companies["symbol"] = df['Symbol']
-        companies["isin"] = df["ISIN"]
-        companies["euronext"] = df["Market"]
-        companies["pea"] = False
-        companies["sector1"] = None
-        companies["sector2"] = None
-        companies["sector3"] = None
-
-        # Récupération des daystocks
-        daystocks = pd.DataFrame()
-        
-        daystocks["cid"] = None
-        daystocks["open"] = pd.to_numeric(df["Open Price"].replace("-", pd.NA), errors="coerce")
-        daystocks["close"] = pd.to_numeric(df["last Price"].replace("-", pd.NA), errors="coerce")
-        daystocks["high"] = pd.to_numeric(df["High Price"].replace("-", pd.NA), errors="coerce")
-        daystocks["low"] = pd.to_numeric(df["low Price"].replace("-", pd.NA), errors="coerce")
-        daystocks["volume"] = pd.to_numeric(df["Volume"].replace("-", pd.NA), errors="coerce")
-        daystocks["mean"] = pd.to_numeric(df["Turnover"].replace("-", pd.NA), errors="coerce") / daystocks["volume"]
-        daystocks["std"] = daystocks[["open", "high", "low", "close"]].std(axis=1)
-        daystocks["name"] = df["Name"]
-        daystocks["euronext"] = df["Market"]
-        daystocks["date"] = get_euronext_date(path)
-
-        #-------------------------------------------------------------------------------------------
-        # Adding companies
-
-        companies['market_names'] = companies['euronext'].apply(get_euronext)
-        
-        # Mapper les noms vers des IDs
-        market_map = existing_markets.set_index('name')['id'].to_dict()
-        companies['market_ids'] = companies['market_names'].apply(
-            lambda names: [market_map[name] for name in names]
-        )
-
-        # Supprimer les lignes sans marché reconnu (si besoin)
-        companies = companies[companies['market_ids'].map(len) > 0]
-
-        # Dupliquer les lignes : une par marché
-        companies = companies.explode('market_ids')
-        companies['mid'] = companies['market_ids'].astype("Int64")
-
-        companies = companies.drop(columns=['market_names', 'market_ids'])
-        
-        market_fields = existing_markets[['id', 'boursorama']].rename(columns={
-            'id': 'mid', 
-        })
-        companies = companies.merge(market_fields, on='mid', how='left')
-
-        # Retrouve le bon Euronext en inversant la map
-        id_to_market = {v: k for k, v in market_map.items()}
-
-        # Remplir la colonne euronext avec le nom du marché correspondant à l’ID
-        companies['euronext'] = companies['mid'].map(id_to_market)
-        
-        # Insérer uniquement les nouvelles sociétés
-        existing_companies = db.df_query("SELECT name, euronext FROM companies")
-
-        # Filtre les nouvelles sociétés basées sur (name, euronext)
-        new_companies = companies[~companies[['name', 'euronext']].apply(tuple, axis=1).isin(
-            existing_companies[['name', 'euronext']].apply(tuple, axis=1))]
-
-        if not new_companies.empty:
-            try:
-                db.df_write(new_companies, 'companies')
-            except Exception as e:
-                print("Erreur lors de l'insertion des companies:", e)
-
-        #-------------------------------------------------------------------------------------------
-        # Adding daystocks
-         # Explode for each euronext
-        daystocks['euronext'] = daystocks['euronext'].apply(get_euronext)
-        daystocks = daystocks.explode('euronext')
-
-        company_id = db.df_query("SELECT id, name, euronext FROM companies")
-
-        company_id_map = company_id.set_index(['name', 'euronext'])['id'].to_dict()
-        daystocks['cid'] = list(zip(daystocks['name'], daystocks['euronext']))
-        daystocks['cid'] = daystocks['cid'].map(company_id_map)
-        daystocks["cid"] = daystocks["cid"].astype("Int64")
-
-        daystocks.drop(columns=["name", "euronext"], inplace=True)
-
-        if not daystocks.empty and daystocks["cid"].notna().all():
-            try:
-                db.df_write(daystocks, 'daystocks')
-            except Exception as e:
-                print("Erreur lors de l'insertion des stocks jounaliers:", e)
-
-        print(path, " indexé")
-    except Exception as e:
-            print(f"Erreur SQL avec {path}: {e}")
-            #db.connection.rollback()
+def insert_euronext(df, db:TSDB, path, existing_markets):
+    companies, daystocks = transform_euronext(df, path, existing_markets)
+    load_euronext(companies, daystocks, db, path)
 
 def parse_price(val):
     if pd.isna(val):
@@ -323,6 +349,21 @@ def parse_price(val):
     else:
         return float(val.replace(' ', '').replace(',', '.')) #nettoyage
 
+def parse_prices(values, errors="raise"):
+    """Vectorized parse_price on a whole column, a float64 Series (NaN for NA).
+
+    The (c) and (s) suffixes are dropped as parse_price does. A value which
+    parse_price could not convert raises ValueError, or becomes NaN with
+    errors="coerce".
+    """
+    if pd.api.types.is_numeric_dtype(values):
+        return values.astype("float64")
+
+    text = values.astype("string").str.strip()
+    text = text.str.replace(r"\((?:c|s)\)| ", "", regex=True).str.replace(",", ".", regex=False)
+    value = pd.to_numeric(text, errors=errors)
+    return pd.Series(value.to_numpy(dtype="float64", na_value=np.nan), index=values.index)
+
 def get_bousorama_date(path):
     # On découpe le chemin par les espaces
     filename = path.split("/")[-1]  # => "compB 2020-05-04 17:32:01.848062.bz2"
@@ -345,99 +386,675 @@ def create_key(boursorama, symbol):
     else:
         return str(boursorama) + str(symbol)
 
-def insert_boursorama(df, db, path, company_id_map):
-    stocks = pd.DataFrame()
+def transform_boursorama(df, date, symbol_index, unmatched=None):
+    """Build the stocks frame of Boursorama snapshots, date is a scalar or a column of df.
+
+    The columns are those of STOCKS_DTYPES, with these types.
+    symbol_index -- SymbolIndex of the companies, rows of unknown companies
+                    have no cid to be stored with and are dropped first
+    unmatched    -- UnmatchedSymbols counting these rows, optional
+    """
+    cid, found = symbol_index.lookup(df['symbol'])
+    if not found.all():
+        if unmatched is not None:
+            unmatched.add(df['symbol'][~found], date[~found] if isinstance(date, pd.Series) else date)
+        df = df[found]
+        cid = cid[found]
+        if isinstance(date, pd.Series):
+            date = date[found]
+
+    stocks = pd.DataFrame({
+        "date": date,
+        "cid": cid,
+        "value": parse_prices(df['last']),
+        "volume": pd.to_numeric(df['volume']),
+    }, index=df.index)
+
+    stocks = stocks[stocks['volume'] != 0].astype(STOCKS_DTYPES) # drop les volumes null (aucun trade, useless)
+    stocks.drop_duplicates(['cid', 'date'], keep='last', inplace=True) # (cid, date) est unique dans la base
+    return stocks
+
+def insert_boursorama(df, db, path, symbol_index, unmatched=None):
     date = get_bousorama_date(path)
-    
-    stocks['value'] =  df['last'].apply(parse_price)
-    stocks['volume'] =  pd.to_numeric(df['volume'])
-    stocks['date'] = date
-    stocks['symbol'] = df['symbol']
+    return transform_boursorama(df, date, symbol_index, unmatched)
 
-    stocks['cid'] = list(zip(stocks['symbol']))
-    stocks['cid'] = stocks['symbol'].map(company_id_map)
-    stocks["cid"] = stocks["cid"].astype("Int64")
+#
+# compacted Boursorama days
+#
 
-    stocks.drop(columns=["symbol"], inplace=True)
-    stocks.drop(stocks[stocks['volume'] == 0].index, inplace=True) # drop les volumes null (aucun trade, useless)
+def compact_path(date):
+    """Parquet file holding all the snapshots of a day"""
+    return os.path.join(cache_dir(), "boursorama", f"{date.isoformat()}.parquet")
 
-    print(date, " Bourso indexe")
-    return stocks
+def _compact_sources(path):
+    """Names of the files covered by a compacted day"""
+    return set(json.loads(pq.read_schema(path).metadata[b"sources"]))
 
+def read_compact_boursorama(files):
+    """Rows of files (all from the same day) from the compacted day, None if it is missing or stale"""
+    if pq is None:
+        return None
+    path = compact_path(get_bousorama_date(files[0]).date())
+    try:
+        if os.path.getmtime(path) < max(os.path.getmtime(f) for f in files):
+            return None
+        names = [os.path.basename(f) for f in files]
+        if not set(names) <= _compact_sources(path):
+            return None
+        return pq.read_table(path, filters=[("source", "in", names)]).to_pandas()
+    except (OSError, KeyError, ValueError):
+        return None
 
-@timer_decorator
-def store_files(start:str, end:str, website:str, db:TSDB):
-    existing_markets = db.df_query("SELECT id, name, alias, boursorama, sws, euronext FROM markets")
-    stocks = []
+def compact_day(files):
+    """Rewrite the snapshots of a day into a single Parquet file.
 
-    if (website == "boursorama"): # sera forcément demandé après indexation des companies
-        companies = db.df_query("SELECT * FROM companies")
-        companies['key'] = companies.apply(lambda row: create_key(row['boursorama'], row['symbol']), axis=1)
-        company_id_map = companies.set_index('key')['id'].to_dict()
-        #company_id_map = company_id.set_index(['symbol'])['id'].to_dict()
+    Only the columns used by transform_boursorama are kept, with the time of the
+    snapshot and the file it comes from. Returns the path written, None if the
+    compacted file was already up to date.
+    """
+    path = compact_path(get_bousorama_date(files[0]).date())
+    names = [os.path.basename(f) for f in files]
+    try:
+        if (os.path.getmtime(path) >= max(os.path.getmtime(f) for f in files)
+                and _compact_sources(path) == set(names)):
+            return None
+    except (OSError, KeyError, ValueError):
+        pass
+
+    frames = []
+    for file, name in zip(files, names):
+        df = read_boursorama(file)
+        if df is None or df.empty:
+            continue
+        frames.append(pd.DataFrame({
+            "symbol": df["symbol"].astype("string"),
+            "last": df["last"].astype("string"),
+            "volume": pd.to_numeric(df["volume"], errors="coerce").astype("float32"),
+            "date": get_bousorama_date(file),
+            "source": name,
+        }))
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+        {"symbol": pd.Series(dtype="string"), "last": pd.Series(dtype="string"),
+         "volume": pd.Series(dtype="float32"), "date": pd.Series(dtype="datetime64[us]"),
+         "source": pd.Series(dtype="string")})
+
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b"sources": json.dumps(names)})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp, compression="zstd")
+    os.replace(tmp, path)
+    return path
 
-    for date in daterange(datetime.strptime(start, "%Y-%m-%d").date(), datetime.strptime(end, "%Y-%m-%d").date()):
-        df = pd.DataFrame()
+def compact_boursorama(start:str, end:str, manifest=None, workers=1):
+    """Compact every day between start and end, store_files then reads one file per day"""
+    if pq is None:
+        print("pyarrow est nécessaire pour compacter les fichiers Boursorama")
+        return
+    if manifest is None:
+        manifest = build_manifest()
+    start = datetime.strptime(start, "%Y-%m-%d").date()
+    end = datetime.strptime(end, "%Y-%m-%d").date()
+    days = [files for date, files in sorted(manifest["boursorama"].items()) if start <= date <= end]
+    for path in ordered_map(compact_day, days, workers):
+        if path is not None:
+            print(path, " compacté")
 
-        if website == "euronext":
-            path = find_euronext(date)
-            if path == None: #coudln't read file
-                continue
 
-            df = read_euronext(path)
-            if df.empty:
+#
+# file manifest
+#
+
+def done_name(path):
+    """Name of a file in the file_done table, relative to HOME so it survives a new mount point"""
+    return os.path.relpath(path, HOME)
+
+def build_manifest(home=None):
+    """Index all the source files by website and day in one pass over the disk.
+
+    Returns {"boursorama": {date: [paths sorted by time]}, "euronext": {date: path}}.
+    Files whose name cannot be parsed by get_bousorama_date or get_euronext_date
+    are ignored. As with find_euronext the csv file wins over the xlsx one.
+    """
+    home = home or HOME
+    boursorama = collections.defaultdict(list)
+    for root, dirs, files in os.walk(os.path.join(home, "boursorama")):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                timestamp = get_bousorama_date(path)
+            except (IndexError, ValueError):
                 continue
+            boursorama[timestamp.date()].append((timestamp, path))
 
-            ext = path.split('.')[-1]
+    euronext = {}
+    base_path = os.path.join(home, "euronext")
+    if os.path.isdir(base_path):
+        for file in sorted(os.listdir(base_path), key=lambda f: not f.endswith(".csv")):
+            if not file.startswith("Euronext_Equities_") or not file.endswith((".csv", ".xlsx")):
+                continue
+            try:
+                date = get_euronext_date(file).date()
+            except ValueError:
+                continue
+            euronext.setdefault(date, os.path.join(base_path, file))
 
-            if (ext == "csv"):
-                insert_euronext_csv(df, db, path, existing_markets)
-            else:
-                insert_euronext_xlsx(df, db, path, existing_markets)
+    return {
+        "boursorama": {date: [path for _, path in sorted(files)] for date, files in boursorama.items()},
+        "euronext": euronext,
+    }
 
+def manifest_files(manifest, website, start, end):
+    """Paths of website between the start and end dates (included), in time order."""
+    files = manifest[website]
+    for date in sorted(d for d in files if start <= d <= end):
         if website == "boursorama":
+            yield from files[date]
+        else:
+            yield files[date]
 
-            files = find_boursorama(date)
-            if files == None or files == []:
-                continue
+#
+# parallel decoding
+#
 
-            for file in files:
-                # for each file detected that month, create and concatenate the stocks DataFrame
-                df = read_boursorama(file)
-                if df.empty:
-                    continue
-
-                #on append les stocks généres
-                stocks.append(insert_boursorama(df, db, file, company_id_map))
-
-                # Si on atteint 60 éléments dans le tableau stocks, on effectue l'insertion et on vide le tableau
-                if len(stocks) >= 60:
-                    try:
-                        db.df_write(pd.concat(stocks, ignore_index=True), 'stocks')
-                        stocks = []  # Vider le tableau après l'insertion
-                        print("INSERTION DANS LA DB")
-                    except Exception as e:
-                        print(f"Erreur lors de l'insertion par lot des stocks Boursorama : {e}")
-    
-    # Insérer le reste des stocks (si il en reste) après la fin de la boucle
-    if len(stocks) > 0:
+_worker_context = {}
+_worker_metrics = Metrics(worker=True)
+
+def _init_worker(context):
+    """Called once in each worker process, avoids sending the context with every file."""
+    global HOME, CACHE, _worker_metrics
+    _worker_context.update(context)
+    _worker_metrics = Metrics(memory=context.get("memory", False), worker=True)
+    HOME = context.get("HOME", HOME)
+    CACHE = context.get("CACHE", CACHE)
+
+def decode_euronext(path):
+    """Read and transform an Euronext file.
+
+    Returns ((path, companies, daystocks) or None, measures of the file).
+    """
+    metrics = _worker_metrics
+    name = done_name(path)
+    with metrics.stage("decode", name) as record:
+        df = read_euronext(path)
+        record["bytes"] = os.path.getsize(path)
+        record["rows"] = 0 if df is None else len(df)
+    if df is None or df.empty:
+        return None, metrics.take()
+    with metrics.stage("transform", name) as record:
+        companies, daystocks = transform_euronext(df, path, _worker_context["existing_markets"])
+        record["rows"] = len(daystocks)
+    return (path, companies, daystocks), metrics.take()
+
+def read_task(files, metrics=None):
+    """Reader stage: load the content of a single file task, compacted days are left to decode_boursorama"""
+    if len(files) > 1:
+        return files, None
+    try:
+        with (metrics or _worker_metrics).stage("read", done_name(files[0])) as record:
+            with open(files[0], "rb") as f:
+                data = f.read()
+            record["bytes"] = len(data)
+        return files, [data]
+    except OSError as e:
+        print(f"Erreur de lecture de {files[0]}: {e}")
+        return files, None
+
+def decode_boursorama(task):
+    """Read and transform Boursorama files of one day.
+
+    task is (files, contents) as given by read_task, the files are read here
+    when contents is None. The compacted day is read instead of the files when
+    it is up to date.
+    Returns ((files, stocks, UnmatchedSymbols) or None, measures of the files).
+    """
+    files, contents = task
+    symbol_index = _worker_context["symbol_index"]
+    metrics = _worker_metrics
+    unmatched = UnmatchedSymbols()
+    df = None
+    if contents is None:
+        with metrics.stage("decode", compact_path(get_bousorama_date(files[0]).date()), len(files)) as record:
+            df = read_compact_boursorama(files)
+            if df is not None:
+                record["rows"] = len(df)
+                record["bytes"] = os.path.getsize(compact_path(get_bousorama_date(files[0]).date()))
+            else:
+                record["files"] = 0 # relus un par un ci-dessous
+    if df is not None:
+        with metrics.stage("transform", record["file"], len(files)) as record:
+            stocks = transform_boursorama(df, df['date'], symbol_index, unmatched)
+            record["rows"] = len(stocks)
+        return (files, stocks, unmatched), metrics.take()
+
+    done = []
+    stocks = []
+    for path, data in zip(files, contents or [None] * len(files)):
+        name = done_name(path)
+        with metrics.stage("decode", name) as record:
+            df = read_boursorama(path, data)
+            record["bytes"] = len(data) if data is not None else os.path.getsize(path)
+            record["rows"] = 0 if df is None else len(df)
+        if df is None or df.empty:
+            continue
         try:
-            db.df_write(pd.concat(stocks, ignore_index=True), 'stocks')
+            with metrics.stage("transform", name) as record:
+                stocks.append(insert_boursorama(df, None, path, symbol_index, unmatched))
+                record["rows"] = len(stocks[-1])
+            done.append(path)
         except Exception as e:
-            print(f"Erreur lors de l'insertion des stocks restants Boursorama : {e}")
-    
+            print(f"Erreur avec {path}: {e}")
+    if not stocks:
+        return None, metrics.take()
+    return (done, pd.concat(stocks, ignore_index=True), unmatched), metrics.take()
+
+def boursorama_tasks(paths):
+    """Tasks of decode_boursorama: a whole day when it has been compacted, one file otherwise"""
+    for date, files in itertools.groupby(paths, key=lambda path: get_bousorama_date(path).date()):
+        files = list(files)
+        if pq is not None and os.path.exists(compact_path(date)):
+            yield files
+        else:
+            for file in files:
+                yield [file]
+
+def ordered_map(func, items, workers=1, context=None):
+    """Like map(func, items) but spread over workers processes.
+
+    Results are yielded in the order of items so the caller, which owns the
+    database connection, writes them as a serial run would. At most 2 * workers
+    files are in flight so memory stays bounded whatever the date range.
+    Workers come from a fork server as the ETL runs threads (see pipeline).
+    """
+    context = {"HOME": HOME, "CACHE": CACHE, **(context or {})}
+    if workers <= 1:
+        _init_worker(context)
+        for item in items:
+            yield func(item)
+        return
+
+    mp_context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                             initializer=_init_worker, initargs=(context,)) as pool:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def store_files(start:str, end:str, website:str, db:TSDB, workers=1, manifest=None, incremental=False,
+                merge=False, batch_rows=500000, batch_bytes=64 * 1024 * 1024, queue_size=8, metrics=None):
+    """Extract, transform and load the files of website between start and end.
+
+    workers     -- number of processes reading and transforming files, the
+                   database is only written by the calling process.
+    manifest    -- result of build_manifest, built here if not given. Share it
+                   between calls to scan the disk only once per run.
+    incremental -- skip the files already recorded in file_done. Every file is
+                   recorded in the transaction which writes its rows, so this
+                   also resumes a run which crashed.
+    merge       -- merge the rows on (cid, date) instead of appending them, so
+                   loading a range again replaces its rows instead of duplicating them.
+    batch_rows, batch_bytes -- Boursorama rows are written once a batch reaches
+                   one of these sizes
+    queue_size  -- results each stage may have ready before the next one takes
+                   them, bounds the memory used
+    metrics     -- Metrics of the run; the totals are printed at the end when not given
+    """
+    own_metrics = metrics is None
+    if own_metrics:
+        metrics = Metrics()
+    metrics.labels["website"] = website
+
+    existing_markets = db.df_query("SELECT id, name, alias, boursorama, sws, euronext FROM markets")
+    with metrics.stage("discovery") as record:
+        if manifest is None:
+            manifest = build_manifest()
+        paths = list(manifest_files(manifest, website, datetime.strptime(start, "%Y-%m-%d").date(),
+                                    datetime.strptime(end, "%Y-%m-%d").date()))
+        if incremental:
+            done = db.done_files()
+            paths = [path for path in paths if done_name(path) not in done]
+        record["files"] = len(paths)
+    metrics.start_progress(" ".join([website, *([metrics.labels["shard"]] if "shard" in metrics.labels else [])]),
+                           len(paths))
+
+    if website == "euronext":
+        with metrics.stage("companies", files=0):
+            registry = CompanyRegistry(db)
+        context = {"existing_markets": existing_markets, "memory": metrics.memory}
+        results = metrics.collect(ordered_map(decode_euronext, paths, workers, context))
+        for result in background(results, queue_size):
+            if result is None: #coudln't read file
+                continue
+            path, companies, daystocks = result
+            load_euronext(companies, daystocks, db, path, registry, merge, metrics)
+        flush_spool(db)
+
+    if website == "boursorama": # sera forcément demandé après indexation des companies
+        with metrics.stage("companies", files=0) as record:
+            symbol_index = boursorama_symbol_index(db)
+            record["rows"] = len(symbol_index)
+
+        # lecture (thread) -> transformation (processus) -> écriture (ici), reliés par des files bornées
+        context = {"symbol_index": symbol_index, "memory": metrics.memory}
+        contents = background((read_task(task, metrics) for task in boursorama_tasks(paths)), queue_size)
+        results = metrics.collect(ordered_map(decode_boursorama, contents, workers, context))
+        unmatched = UnmatchedSymbols()
+        results = split_unmatched(background(results, queue_size), unmatched)
+        for files, stocks in batches(results, batch_rows, batch_bytes):
+            try:
+                with metrics.stage("copy", files=len(files)) as record:
+                    record["rows"] = sum(len(frame) for frame in stocks)
+                    record["bytes"] = sum(int(frame.memory_usage(index=False).sum()) for frame in stocks)
+                    db.df_write(stocks, 'stocks', done=[done_name(path) for path in files], merge=merge)
+            except Exception as e:
+                print(f"Erreur lors de l'insertion par lot des stocks Boursorama : {e}")
+
+        flush_spool(db)
+        report_unmatched(unmatched, db, metrics)
+
+        # valeurs journalières des sociétés absentes des fichiers Euronext
+        with metrics.stage("refresh", files=0):
+            db.refresh_daystocks(start, end)
+
+    metrics.end_progress()
+    if own_metrics:
+        metrics.summary()
     return
 
+def boursorama_symbol_index(db):
+    """Return the SymbolIndex of the companies of the database"""
+    companies = db.df_query("SELECT id, symbol, boursorama FROM companies")
+    if companies.empty:
+        return SymbolIndex([], [])
+    return SymbolIndex.from_companies(companies)
+
+def flush_spool(db):
+    """Write the batches spooled while the database was unreachable, waiting for it up to db.spool_wait"""
+    if not db.replay_spool():
+        print(f"{len(db.spool)} lots restent en attente dans {db.spool.folder}, ils seront écrits au prochain lancement")
+
+def split_unmatched(results, unmatched):
+    """Yield the (files, stocks) of decode_boursorama results, their unmatched symbols go to unmatched"""
+    for result in results:
+        if result is not None:
+            files, stocks, found = result
+            unmatched.update(found)
+            result = files, stocks
+        yield result
+
+def report_unmatched(unmatched, db, metrics):
+    """Print the symbols without company of a run and add them to the unmatched_symbols table"""
+    if not unmatched:
+        return
+    print(unmatched.report())
+    metrics.add({"stage": "unmatched", "file": None, "files": 0, "rows": unmatched.rows, "bytes": 0,
+                 "seconds": 0.0, "symbols": len(unmatched)})
+    try:  # un simple compte, il ne doit pas arrêter le chargement
+        db.add_unmatched_symbols(unmatched.table_rows())
+    except Exception as e:
+        print(f"Attention : symboles sans société non enregistrés : {e}")
+
+#
+# watch mode
+#
+
+def ingest_files(paths, db, existing_markets, registry, symbol_index, merge=False, metrics=None):
+    """Load new files of both websites in one go, Euronext first.
+
+    The Boursorama files are written with one COPY. Returns the symbol_index
+    to use next, rebuilt when Euronext files created companies, and the
+    done names of the files written (or spooled).
+    """
+    if metrics is None:
+        metrics = Metrics()
+    website = lambda path: done_name(path).split(os.sep)[0]
+
+    known = len(registry)
+    written = set()
+    for path in sorted(p for p in paths if website(p) == "euronext"):
+        name = done_name(path)
+        try:
+            with metrics.stage("decode", name) as record:
+                df = read_euronext(path)
+                record["rows"] = 0 if df is None else len(df)
+            if df is None:
+                continue
+            with metrics.stage("transform", name) as record:
+                companies, daystocks = transform_euronext(df, path, existing_markets)
+                record["rows"] = len(daystocks)
+            if load_euronext(companies, daystocks, db, path, registry, merge, metrics):
+                written.add(name)
+        except Exception as e:
+            print(f"Erreur avec {path}: {e}")
+    if len(registry) != known:
+        symbol_index = boursorama_symbol_index(db)
+
+    names, frames, days = [], [], set()
+    unmatched = UnmatchedSymbols()
+    for path in sorted(p for p in paths if website(p) == "boursorama"):
+        name = done_name(path)
+        try:
+            date = get_bousorama_date(path)
+            with metrics.stage("decode", name) as record:
+                df = read_boursorama(path)
+                record["rows"] = 0 if df is None else len(df)
+            if df is None:
+                continue
+            with metrics.stage("transform", name) as record:
+                frames.append(transform_boursorama(df, date, symbol_index, unmatched))
+                record["rows"] = len(frames[-1])
+            names.append(name)
+            days.add(date.date())
+        except Exception as e:
+            print(f"Erreur avec {path}: {e}")
+    if names:
+        try:
+            with metrics.stage("copy", files=len(names)) as record:
+                record["rows"] = sum(len(frame) for frame in frames)
+                db.df_write(frames, 'stocks', done=names, merge=merge)
+            written.update(names)
+            with metrics.stage("refresh", files=0):
+                db.refresh_daystocks(min(days), max(days))
+        except Exception as e:
+            print(f"Erreur lors de l'insertion des stocks Boursorama : {e}")
+    report_unmatched(unmatched, db, metrics)
+    return symbol_index, written
+
+def watch_files(db, files=None, interval=5, batch_seconds=2, merge=False, metrics=None, retries=3):
+    """Load the files written in HOME/euronext and HOME/boursorama as they arrive, never returns.
+
+    files         -- watcher created before the last full load, so that the
+                     files written during it are not missed; created here if not given
+    batch_seconds -- files arriving within this delay are loaded together
+    Files already in file_done are skipped. A file which could not be written
+    is tried again with the next new files, retries times at most.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    if files is None:
+        files = watcher([os.path.join(HOME, "euronext"), os.path.join(HOME, "boursorama")], interval)
+    print(f"Surveillance de {HOME} ({type(files).__name__})")
+    metrics.labels["website"] = "watch"
+    existing_markets = db.df_query("SELECT id, name, alias, boursorama, sws, euronext FROM markets")
+    registry = CompanyRegistry(db)
+    symbol_index = boursorama_symbol_index(db)
+    done = db.done_files()
+
+    pending, deadline = [], None
+    failed = {}  # path -> attempts, of the files not written yet
+    for paths in files:
+        pending.extend(path for path in paths if done_name(path) not in done and path not in pending)
+        if pending and deadline is None:
+            deadline = time.monotonic() + batch_seconds
+        if pending and time.monotonic() >= deadline:
+            batch = pending + [path for path in failed if path not in pending]
+            symbol_index, written = ingest_files(batch, db, existing_markets, registry, symbol_index, merge,
+                                                 metrics)
+            done.update(written)
+            for path in batch:
+                if done_name(path) in done:
+                    failed.pop(path, None)
+                elif failed.get(path, 0) + 1 >= retries:
+                    print(f"{path} abandonné après {retries} essais")
+                    failed.pop(path, None)
+                else:
+                    failed[path] = failed.get(path, 0) + 1
+            print(f"{datetime.now():%H:%M:%S} {len(written)} nouveaux fichiers chargés"
+                  + (f", {len(failed)} à réessayer" if failed else ""))
+            pending, deadline = [], None
+
+#
+# shards
+#
+
+def month_shards(start:str, end:str):
+    """Split the days between start and end (included) by month, returns (start, end) strings"""
+    start = datetime.strptime(start, "%Y-%m-%d").date()
+    end = datetime.strptime(end, "%Y-%m-%d").date()
+    shards = []
+    while start <= end:
+        next_month = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        shards.append((start.isoformat(), min(end, next_month - timedelta(days=1)).isoformat()))
+        start = next_month
+    return shards
+
+def store_shard(shard):
+    """Worker of store_sharded: load (website, start, end) with its own connection.
+
+    Returns the stage totals of the shard.
+    """
+    website, start, end = shard
+    context = _worker_context
+    db = TSDB(*context["database"], setup=False)
+    db.bulk_load = context["bulk_load"]
+    db.use_spool(Spool(os.path.join(context["spool"], str(os.getpid()))), context["spool_wait"])
+    metrics = Metrics(context["report"], context["memory"])
+    metrics.labels["shard"] = start[:7]
+    try:
+        store_files(start, end, website, db, context["decoders"], context["manifest"], context["incremental"],
+                    context["merge"], metrics=metrics)
+    finally:
+        metrics.close()
+        db.connection.close()
+    return metrics.totals
+
+def store_sharded(start:str, end:str, database, shards=2, workers=1, manifest=None, incremental=False,
+                  merge=False, metrics=None, bulk_load=False, spool=None, spool_wait=0):
+    """Load Euronext then Boursorama between start and end, one month per shard.
+
+    database -- arguments of TimescaleStockMarketModel, each shard opens its own connection
+    shards   -- months loaded at the same time, each in its own process
+    workers  -- processes decoding the files of each shard
+    bulk_load -- the indexes have been dropped by begin_bulk_load
+    spool    -- folder where each shard spools the batches the database does
+                not take (see Spool), cache_dir()/spool by default
+    The Boursorama shards start once every Euronext month is loaded as they
+    need all the companies. Euronext shards create companies concurrently,
+    CompanyRegistry.add serializes them with an advisory lock.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    if manifest is None:
+        manifest = build_manifest()
+    context = {"database": database, "decoders": workers, "manifest": manifest, "incremental": incremental,
+               "merge": merge, "report": metrics.report_path, "memory": metrics.memory, "bulk_load": bulk_load,
+               "spool": spool or os.path.join(cache_dir(), "spool"), "spool_wait": spool_wait}
+    for website in ("euronext", "boursorama"):
+        tasks = [(website, first, last) for first, last in month_shards(start, end)]
+        for totals in ordered_map(store_shard, tasks, shards, context):
+            metrics.add_totals(totals)
+
 
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Extract, Transform and Load the stock market files")
+    parser.add_argument("--start", default="2020-01-01", help="first day to load (YYYY-MM-DD)")
+    parser.add_argument("--end", default="2021-01-01", help="last day to load (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("ETL_WORKERS", os.cpu_count() or 1)),
+                        help="processes used to read and transform files")
+    parser.add_argument("--incremental", action="store_true",
+                        help="keep the database and only load files missing from file_done")
+    parser.add_argument("--merge", action="store_true",
+                        help="keep the database and replace the rows of the files loaded again")
+    parser.add_argument("--compact", action="store_true",
+                        help="compact the Boursorama files of each day before loading them")
+    parser.add_argument("--shards", type=int, default=int(os.environ.get("ETL_SHARDS", 1)),
+                        help="months loaded at the same time, the --workers processes are shared between them")
+    parser.add_argument("--compress-after", default=os.environ.get("ETL_COMPRESS_AFTER", "30 days"),
+                        help="age of the chunks compressed by TimescaleDB, 'never' to disable")
+    parser.add_argument("--compress", action="store_true",
+                        help="compress the chunks older than --compress-after at the end of the load")
+    parser.add_argument("--watch", action="store_true",
+                        help="after the load, keep loading the new files as they arrive")
+    parser.add_argument("--watch-interval", type=float, default=5,
+                        help="seconds between two scans of the folders when inotify is not available")
+    parser.add_argument("--spool-wait", type=float, default=300,
+                        help="seconds to wait at the end of a load for the database to take the spooled batches")
+    parser.add_argument("--report", default=os.environ.get("ETL_REPORT"),
+                        help="append the measures of each stage to this JSON lines file")
+    parser.add_argument("--memory", action="store_true",
+                        help="measure the memory peak of each stage (slower)")
+    args = parser.parse_args()
+
     print("Go Extract Transform and Load")
     pd.set_option('display.max_columns', None)  # usefull for dedugging
-    db = tsdb.TimescaleStockMarketModel('bourse', 'ricou', 'db', 'monmdp')        # inside docker
-    #db = tsdb.TimescaleStockMarketModel('bourse', 'ricou', 'localhost', 'monmdp') # outside docker
-    db._purge_database()
+    database = ('bourse', 'ricou', 'db', 'monmdp')          # inside docker
+    #database = ('bourse', 'ricou', 'localhost', 'monmdp')  # outside docker
+    compress_after = None if args.compress_after == "never" else args.compress_after
+    db = tsdb.TimescaleStockMarketModel(*database, compress_after=compress_after)
+    spool = os.path.join(cache_dir(), "spool")
+    if not args.incremental and not args.merge:
+        db._purge_database()
+        Spool(spool).clear()
     db._setup_database()
-    store_files("2020-01-01", "2021-01-01", "euronext", db) #un an pour tester, à changer si besoin
-    store_files("2020-01-01", "2021-01-01", "boursorama", db)
-    print("Done Extract Transform and Load")
\ No newline at end of file
+    # lots qu'une exécution précédente n'a pas pu écrire, avant de chercher les fichiers à charger
+    db.use_spool(Spool(spool), args.spool_wait)
+    flush_spool(db)
+    db.use_spool(Spool(os.path.join(spool, str(os.getpid()))), args.spool_wait)
+    metrics = Metrics(args.report, args.memory)
+    # avant le chargement, pour ne pas rater les fichiers écrits pendant
+    new_files = watcher([os.path.join(HOME, "euronext"), os.path.join(HOME, "boursorama")],
+                        args.watch_interval) if args.watch else None
+    with metrics.stage("discovery") as record:
+        manifest = build_manifest()
+        record["files"] = sum(len(files) for files in manifest["boursorama"].values()) + len(manifest["euronext"])
+    if args.compact:
+        compact_boursorama(args.start, args.end, manifest, args.workers)
+    # base vide : les index sont construits une fois à la fin plutôt qu'à chaque COPY
+    bulk_load = db.is_empty("stocks") and db.is_empty("daystocks")
+    if bulk_load:
+        db.begin_bulk_load()
+    try:
+        try:
+            if args.shards > 1:
+                store_sharded(args.start, args.end, database, args.shards, max(1, args.workers // args.shards),
+                              manifest, args.incremental, args.merge, metrics, bulk_load, spool, args.spool_wait)
+            else:
+                for website in ("euronext", "boursorama"):
+                    store_files(args.start, args.end, website, db, args.workers, manifest, args.incremental,
+                                args.merge, metrics=metrics)
+        finally:
+            if bulk_load:
+                with metrics.stage("index", files=0):
+                    db.end_bulk_load()
+        # après un chargement complet, les vieux morceaux sont compressés sans attendre la politique
+        if bulk_load or args.compress:
+            with metrics.stage("compress", files=0) as record:
+                record["rows"] = db.compress_chunks()
+    finally:
+        if bulk_load:  # mise en pause par begin_bulk_load
+            db.schedule_compression(True)
+    metrics.summary()
+    if args.watch:
+        try:
+            watch_files(db, new_files, args.watch_interval, merge=args.merge, metrics=metrics)
+        except KeyboardInterrupt:
+            metrics.summary()
+    metrics.close()
+    print("Done Extract Transform and Load")
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Mesures de l'ETL par étape : durée, lignes, octets et pic mémoire.
+
+  Chaque mesure (un fichier, un lot écrit...) est une ligne JSON du rapport,
+  les totaux par étape sont ajoutés à la fin de l'exécution. Les processus de
+  décodage mesurent de leur côté et renvoient leurs mesures avec leurs
+  résultats (cf take et collect).
+
+  Le pic mémoire vient de tracemalloc, activé seulement sur demande car il
+  ralentit pandas. Il est mesuré pour tout le processus : quand des étapes
+  tournent en même temps dans des threads, il est approximatif.
+'''
+
+import contextlib
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+STAGES = ("discovery", "read", "decode", "transform", "companies", "unmatched", "copy", "refresh", "index", "compress")
+
+
+class Metrics:
+    """Collect stage measures, write them to a JSON lines report and show the progress."""
+
+    def __init__(self, report=None, memory=False, progress_every=30, worker=False):
+        """report         -- path of the JSON lines report, appended; no report if None
+        memory         -- measure the memory peak of each stage with tracemalloc
+        progress_every -- seconds between two progress lines when stderr is not a terminal
+        worker         -- only keep the records until take() is called
+        """
+        self.worker = worker
+        self.run = datetime.now().isoformat(timespec="seconds")
+        self.labels = {}
+        self.memory = memory
+        self.report_path = report
+        # a write per line: the shards of a run append to the same report
+        self.report = open(report, "a", buffering=1) if report else None
+        self.pending = []
+        self.totals = {}
+        self.lock = threading.Lock()
+        self.progress_every = progress_every
+        self.tty = sys.stderr.isatty()
+        self._progress = None
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name, file=None, files=1):
+        """Measure the with block, fill rows and bytes of the yielded record"""
+        record = {"stage": name, "file": file, "files": files, "rows": 0, "bytes": 0}
+        if self.memory:
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 6)
+            if self.memory:
+                record["peak_mb"] = round((tracemalloc.get_traced_memory()[1] - current) / 1e6, 3)
+            self.add(record)
+
+    def add(self, record):
+        """Record a measure, from this process or sent back by a worker"""
+        if self.worker:
+            with self.lock:
+                self.pending.append(record)
+            return
+        record = {**self.labels, **record}
+        with self.lock:
+            total = self.totals.setdefault((record.get("website"), record["stage"]),
+                                           {"count": 0, "files": 0, "rows": 0, "bytes": 0, "seconds": 0.0})
+            total["count"] += 1
+            for key in ("files", "rows", "bytes", "seconds"):
+                total[key] += record[key]
+            if "peak_mb" in record:
+                total["peak_mb"] = max(total.get("peak_mb", 0), record["peak_mb"])
+            if self.report is not None:
+                self.report.write(json.dumps({"run": self.run, **record}) + "\n")
+        if record["stage"] == "decode":
+            self.advance(record["files"], record["rows"])
+
+    def add_totals(self, totals):
+        """Add the stage totals of another Metrics, a shard run in another process"""
+        with self.lock:
+            for key, other in totals.items():
+                total = self.totals.setdefault(key, {"count": 0, "files": 0, "rows": 0, "bytes": 0, "seconds": 0.0})
+                for name in ("count", "files", "rows", "bytes", "seconds"):
+                    total[name] += other[name]
+                if "peak_mb" in other:
+                    total["peak_mb"] = max(total.get("peak_mb", 0), other["peak_mb"])
+
+    def take(self):
+        """Return and forget the records of this process, workers send them to the main process"""
+        with self.lock:
+            records, self.pending = self.pending, []
+        return records
+
+    def collect(self, results):
+        """Add the records of (result, records) couples returned by workers, yield the results"""
+        for result, records in results:
+            for record in records:
+                self.add(record)
+            yield result
+
+    def start_progress(self, label, total):
+        """Show a progress line for total files, updated by the decode records"""
+        now = time.perf_counter()
+        self._progress = {"label": label, "total": total, "files": 0, "rows": 0, "start": now, "shown": 0}
+
+    def advance(self, files, rows):
+        progress = self._progress
+        if progress is None:
+            return
+        progress["files"] += files
+        progress["rows"] += rows
+        now = time.perf_counter()
+        if now - progress["shown"] >= (0.5 if self.tty else self.progress_every):
+            progress["shown"] = now
+            self._show(now)
+
+    def _show(self, now, end="\r"):
+        progress = self._progress
+        elapsed = now - progress["start"]
+        done, total = progress["files"], progress["total"]
+        line = f"{progress['label']}: {done}/{total} fichiers"
+        if total:
+            line += f" ({done / total:.0%})"
+        if elapsed > 0:
+            line += f", {progress['rows'] / elapsed:,.0f} lignes/s"
+        if done and total and done < total:
+            line += f", reste {timedelta(seconds=int(elapsed * (total - done) / done))}"
+        if self.tty:
+            sys.stderr.write(f"\033[K{line}{end}")
+        else:
+            sys.stderr.write(line + "\n")
+        sys.stderr.flush()
+
+    def end_progress(self):
+        if self._progress is not None:
+            self._show(time.perf_counter(), end="\n")
+            self._progress = None
+
+    def summary(self):
+        """Write the totals of each stage to the report and print them"""
+        print(f"{'website':12} {'stage':10} {'files':>8} {'rows':>12} {'MB':>10} {'seconds':>9} {'rows/s':>11} {'peak MB':>8}")
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        for (website, stage), total in sorted(self.totals.items(),
+                                              key=lambda item: (str(item[0][0]), order.get(item[0][1], len(order)))):
+            seconds = total["seconds"]
+            rate = f"{total['rows'] / seconds:,.0f}" if seconds and total["rows"] else "-"
+            print(f"{website or '-':12} {stage:10} {total['files']:>8} {total['rows']:>12} "
+                  f"{total['bytes'] / 1e6:>10.1f} {seconds:>9.2f} {rate:>11} {total.get('peak_mb', '-'):>8}")
+            if self.report is not None:
+                self.report.write(json.dumps({"run": self.run, "website": website, "stage": stage,
+                                              "total": True, **total}) + "\n")
+        if self.report is not None:
+            self.report.flush()
+
+    def close(self):
+        if self.report is not None:
+            self.report.close()
+            self.report = None
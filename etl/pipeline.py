@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Étages de l'ETL reliés par des files bornées.
+
+  Chaque étage tourne dans son propre thread et ne prend que maxsize éléments
+  d'avance sur le suivant : quand l'écriture dans la base ralentit, la lecture
+  et la transformation attendent au lieu d'accumuler des DataFrames.
+'''
+
+import queue
+import threading
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def background(iterable, maxsize=8):
+    """Iterate iterable in a thread, at most maxsize items ahead of the caller.
+
+    Exceptions of the thread are raised in the caller. If the caller stops
+    iterating, the thread stops at its next item.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Failure(e))
+        finally:
+            put(_END)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+
+def batches(results, target_rows=500000, target_bytes=64 * 1024 * 1024):
+    """Group (names, frame) results into (names, frames) batches.
+
+    A batch is yielded as soon as it holds target_rows rows or target_bytes
+    bytes of frames, whatever the number of files it comes from.
+    """
+    names = []
+    frames = []
+    rows = 0
+    size = 0
+    for result in results:
+        if result is None:
+            continue
+        result_names, frame = result
+        names.extend(result_names)
+        frames.append(frame)
+        rows += len(frame)
+        size += int(frame.memory_usage(index=False).sum())
+        if rows >= target_rows or size >= target_bytes:
+            yield names, frames
+            names, frames, rows, size = [], [], 0, 0
+    if names:
+        yield names, frames
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+'''
+  File d'attente sur disque des lots que la base n'a pas pu recevoir.
+
+  Quand la base ne répond plus, df_write écrit le lot ici au lieu de le perdre
+  (cf TimescaleStockMarketModel.use_spool) et l'ETL continue de lire et de
+  transformer les fichiers. Les lots sont rejoués dans leur ordre d'arrivée
+  dès que la base revient, ou au démarrage suivant de l'ETL.
+
+  Un lot est un fichier Parquet (pickle sans pyarrow) et un fichier JSON avec
+  la table, les fichiers d'origine pour file_done et le mode merge. Le JSON
+  est écrit en dernier : un lot sans JSON est incomplet et ignoré.
+'''
+
+import itertools
+import json
+import os
+import shutil
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pickle à la place de Parquet
+    pq = None
+
+_counter = itertools.count()
+
+
+class Spool:
+    """Batches of rows waiting for the database, in folder and its subfolders."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def __len__(self):
+        return len(self.pending())
+
+    def put(self, table, frames, done=None, merge=False):
+        """Store a dataframe, or a list of dataframes with the same columns, to write in table later"""
+        frame = frames if isinstance(frames, pd.DataFrame) else pd.concat(list(frames), ignore_index=True)
+        os.makedirs(self.folder, exist_ok=True)
+        # time first so that the batches of all the processes sort in their order of arrival
+        name = os.path.join(self.folder, f"{time.time_ns():020d}-{os.getpid()}-{next(_counter):06d}")
+        data = name + (".parquet" if pq is not None else ".pkl")
+        if pq is not None:
+            frame.to_parquet(data, index=False, compression="zstd")
+        else:
+            frame.to_pickle(data)
+        meta = {"table": table, "data": os.path.basename(data), "done": list(done or []), "merge": merge,
+                "rows": len(frame)}
+        with open(name + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(name + ".json.tmp", name + ".json")
+        return name + ".json"
+
+    def pending(self):
+        """Paths of the complete batches, oldest first"""
+        batches = []
+        for root, dirs, files in os.walk(self.folder):
+            dirs[:] = [d for d in dirs if d != "failed"]
+            batches.extend(os.path.join(root, f) for f in files if f.endswith(".json"))
+        return sorted(batches, key=os.path.basename)
+
+    def meta(self, batch):
+        with open(batch) as f:
+            return json.load(f)
+
+    def load(self, batch):
+        """Return (table, frame, done, merge) of a batch"""
+        meta = self.meta(batch)
+        data = os.path.join(os.path.dirname(batch), meta["data"])
+        frame = pd.read_parquet(data) if data.endswith(".parquet") else pd.read_pickle(data)
+        return meta["table"], frame, meta["done"], meta["merge"]
+
+    def remove(self, batch):
+        """Forget a batch written in the database"""
+        data = os.path.join(os.path.dirname(batch), self.meta(batch)["data"])
+        os.remove(batch)  # the batch is gone even if the data file stays
+        os.remove(data)
+
+    def reject(self, batch):
+        """Move aside a batch the database refuses, to look at it by hand"""
+        failed = os.path.join(self.folder, "failed")
+        os.makedirs(failed, exist_ok=True)
+        data = os.path.join(os.path.dirname(batch), self.meta(batch)["data"])
+        shutil.move(data, failed)
+        shutil.move(batch, failed)
+
+    def clear(self):
+        """Remove every batch, when the database is emptied"""
+        shutil.rmtree(self.folder, ignore_errors=True)
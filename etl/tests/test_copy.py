@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Aller-retour de l'encodeur COPY binaire de l'ETL (_encode_binary) : les
+  tuples produits sont relus par un décodeur écrit à la main avec struct.
+'''
+
+import os
+import struct
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import timescaledb_model as tsdb  # noqa: E402
+
+PG_EPOCH = pd.Timestamp("2000-01-01", tz="UTC")
+
+
+def decode(data, formats):
+    """Rows of binary COPY tuples, None for NULL"""
+    rows, pos = [], 0
+    while pos < len(data):
+        (count,) = struct.unpack_from(">h", data, pos)
+        pos += 2
+        assert count == len(formats)
+        row = []
+        for fmt in formats:
+            (size,) = struct.unpack_from(">i", data, pos)
+            pos += 4
+            if size == -1:
+                row.append(None)
+                continue
+            assert size == struct.calcsize(fmt)
+            row.append(struct.unpack_from(fmt, data, pos)[0])
+            pos += size
+        rows.append(tuple(row))
+    return rows
+
+
+def micros(timestamp):
+    """Value of a timestamptz in binary COPY: microseconds since 2000-01-01 UTC"""
+    return (pd.Timestamp(timestamp) - PG_EPOCH) // pd.Timedelta(microseconds=1)
+
+
+def test_nulls_and_nan():
+    df = pd.DataFrame({"cid": pd.array([1, None, 3], dtype="Int64"),
+                       "value": [1.5, np.nan, None]})
+    data = tsdb._encode_binary(df, {"cid": "int2", "value": "float4"}, "UTC")
+    rows = decode(data, [">h", ">f"])
+    assert sorted(rows, key=str) == sorted([(1, 1.5), (None, None), (3, None)], key=str)
+
+
+def test_float4_rounding():
+    values = [0.1, 123.456, -7.25, 1e30]
+    data = tsdb._encode_binary(pd.DataFrame({"value": values}), {"value": "float4"}, "UTC")
+    assert [row[0] for row in decode(data, [">f"])] == [float(np.float32(v)) for v in values]
+
+
+def test_int2_overflow():
+    df = pd.DataFrame({"cid": pd.array([1, 40000], dtype="Int64")})
+    with pytest.raises(OverflowError):
+        tsdb._encode_binary(df, {"cid": "int2"}, "UTC")
+    df = pd.DataFrame({"cid": np.array([-32768, 32767], dtype="int64")})
+    rows = decode(tsdb._encode_binary(df, {"cid": "int2"}, "UTC"), [">h"])
+    assert rows == [(-32768,), (32767,)]
+
+
+def test_timestamptz_across_dst():
+    # Paris passe à l'heure d'été le 2020-03-29 à 2 h, 02:30 n'existe pas ce jour-là
+    naive = pd.Series(pd.to_datetime(["2020-03-29 01:30", "2020-03-29 02:30", "2020-03-29 03:30"]))
+    data = tsdb._encode_binary(pd.DataFrame({"date": naive}), {"date": "timestamptz"}, "Europe/Paris")
+    assert decode(data, [">q"]) == [(micros("2020-03-29 00:30Z"),), (micros("2020-03-29 01:00Z"),),
+                                     (micros("2020-03-29 01:30Z"),)]
+    # les dates avec fuseau ne dépendent pas de celui de la session
+    aware = naive.dt.tz_localize("UTC")
+    data = tsdb._encode_binary(pd.DataFrame({"date": aware}), {"date": "timestamptz"}, "Europe/Paris")
+    assert decode(data, [">q"]) == [(micros(t),) for t in aware]
+
+
+def test_unknown_session_timezone():
+    naive = pd.Series(pd.to_datetime(["2020-01-01 12:00", None]))
+    data = tsdb._encode_binary(pd.DataFrame({"date": naive}), {"date": "timestamptz"}, "<+02>-02")
+    assert sorted(decode(data, [">q"]), key=str) == sorted([(micros("2020-01-01 12:00Z"),), (None,)], key=str)
+
+
+def test_daystocks_frame():
+    df = pd.DataFrame({"date": pd.to_datetime(["2021-06-01", "2021-06-02"]), "cid": [7, 7],
+                       "open": [1.0, 2.0], "volume": [10.0, np.nan]})
+    types = {"date": "timestamptz", "cid": "int2", "open": "float4", "volume": "float4"}
+    rows = decode(tsdb._encode_binary(df, types, "UTC"), [">q", ">h", ">f", ">f"])
+    assert sorted(rows, key=str) == sorted([(micros("2021-06-01 00:00Z"), 7, 1.0, 10.0),
+                                            (micros("2021-06-02 00:00Z"), 7, 2.0, None)], key=str)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+'''
+  parse_prices (vectorisée, colonne entière) donne les mêmes valeurs que
+  parse_price appliquée valeur par valeur.
+'''
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import etl  # noqa: E402
+
+PRICES = ["12,5", "12.5", "1 234,56", " 7,25 ", "3,1(c)", "3,1 (c)", "45(s)",
+          " 1 000,5 (s) ", "0", "-2,75", "1e3", None]
+
+
+def expected(values):
+    return [np.nan if v is None else v for v in map(etl.parse_price, values)]
+
+
+@pytest.mark.parametrize("dtype", [object, "string"])
+def test_same_as_parse_price(dtype):
+    values = pd.Series(PRICES, dtype=dtype)
+    result = etl.parse_prices(values)
+    assert result.dtype == "float64"
+    np.testing.assert_array_equal(result.to_numpy(), expected(PRICES))
+
+
+def test_numeric_column():
+    values = pd.Series([1.5, np.nan, 3.0])
+    np.testing.assert_array_equal(etl.parse_prices(values).to_numpy(), expected([1.5, None, 3.0]))
+
+
+def test_index_kept():
+    values = pd.Series(["1,5", "2(c)"], index=[10, 20])
+    assert etl.parse_prices(values).index.tolist() == [10, 20]
+
+
+def test_unparseable():
+    values = pd.Series(["1,5", "n/a"])
+    with pytest.raises(ValueError):
+        etl.parse_price(values[1])
+    with pytest.raises(ValueError):
+        etl.parse_prices(values)
+    np.testing.assert_array_equal(etl.parse_prices(values, errors="coerce").to_numpy(), [1.5, np.nan])
@@ -5,7 +5,10 @@ import time
 import io
 import os
 import csv
+import itertools
+import threading
 import psycopg2
+import psycopg2.extras
 import numpy as np
 import pandas as pd
 import sqlalchemy
@@ -26,6 +29,18 @@ initial_markets_data = (
     (100, "International", "int", "", "", ""),  # should be last one
 )
 
+# errors of a database which cannot be reached, the batches are then spooled (see use_spool)
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, sqlalchemy.exc.OperationalError)
+
+# (table, index, columns, unique) of the indexes dropped during a bulk load, the
+# (cid, date) ones and the date index TimescaleDB creates with each hypertable
+bulk_indexes = (
+    ("stocks", "idx_cid_stocks", "cid, date DESC", True),
+    ("daystocks", "idx_cid_daystocks", "cid, date DESC", True),
+    ("stocks", "stocks_date_idx", "date DESC", False),
+    ("daystocks", "daystocks_date_idx", "date DESC", False),
+)
+
 def _psql_insert_copy(table, conn, keys, data_iter):  # mehod used by df_write
     """
     Execute SQL statement inserting data
@@ -57,16 +72,127 @@ def _psql_insert_copy(table, conn, keys, data_iter):  # mehod used by df_write
         cur.copy_expert(sql=sql, file=s_buf)
 
 
+# Binary COPY format, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + (0).to_bytes(4, "big") + (0).to_bytes(4, "big")
+PGCOPY_TRAILER = (-1).to_bytes(2, "big", signed=True)
+PG_EPOCH = np.datetime64("2000-01-01T00:00:00", "us")
+
+# Postgres type -> numpy type of its binary representation
+_binary_types = {
+    "float4": ">f4",
+    "float8": ">f8",
+    "int2": ">i2",
+    "int4": ">i4",
+    "int8": ">i8",
+    "bool": "?",
+    "timestamptz": ">i8",  # microseconds since PG_EPOCH
+    "timestamp": ">i8",
+    "date": ">i4",         # days since PG_EPOCH
+}
+
+def _binary_column(col, pg_type, timezone):
+    """Return (null mask, numpy values in the binary COPY representation) of a column"""
+    if pg_type in ("timestamptz", "timestamp", "date"):
+        col = pd.to_datetime(col)
+        if col.dt.tz is None and pg_type == "timestamptz":
+            # naive dates are read in the session time zone, as the text formats do
+            try:
+                col = col.dt.tz_localize(timezone, ambiguous=False, nonexistent="shift_forward")
+            except Exception:  # a POSIX TimeZone setting pandas does not know, read in UTC
+                col = col.dt.tz_localize("UTC")
+        if col.dt.tz is not None:
+            col = col.dt.tz_convert("UTC").dt.tz_localize(None)
+        mask = col.isna().to_numpy()
+        values = np.where(mask, PG_EPOCH, col.to_numpy(dtype="datetime64[us]")) - PG_EPOCH
+        values = values // np.timedelta64(1, "D" if pg_type == "date" else "us")
+    else:
+        mask = col.isna().to_numpy()
+        if mask.any() or not isinstance(col.dtype, np.dtype):
+            values = col.where(~mask, 0).to_numpy()
+        else:
+            values = col.to_numpy()  # already of the table type with the ETL frames, no copy
+        target = np.dtype(_binary_types[pg_type])
+        if target.kind == "i" and values.dtype.kind in "iu" and values.dtype.itemsize >= target.itemsize and len(values):
+            # astype would wrap around, Postgres refuses these values in the other formats
+            info = np.iinfo(target)
+            if values.min() < info.min or values.max() > info.max:
+                raise OverflowError(f"{col.name}: values out of range for {pg_type}")
+    return mask, values.astype(_binary_types[pg_type])
+
+def _encode_binary(df, pg_types, timezone):
+    """Encode the rows of df as binary COPY tuples, without the header and trailer.
+
+    Rows are grouped by their pattern of NULLs so that each group is a fixed
+    width numpy record array written in one go. Rows do not keep their order,
+    which does not matter for a table.
+    """
+    columns = [_binary_column(df[c], pg_types[c], timezone) for c in df.columns]
+    masks = np.column_stack([mask for mask, _ in columns]) if columns else np.zeros((len(df), 0), bool)
+    if masks.any():
+        patterns, inverse = np.unique(masks, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+    else:
+        patterns, inverse = masks[:1], None
+
+    chunks = []
+    for p, pattern in enumerate(patterns):
+        rows = slice(None) if inverse is None else np.flatnonzero(inverse == p)
+        fields = [("n", ">i2")]
+        for k, (_, values) in enumerate(columns):
+            fields.append((f"l{k}", ">i4"))
+            if not pattern[k]:
+                fields.append((f"v{k}", values.dtype))
+        size = len(df) if inverse is None else len(rows)
+        rec = np.empty(size, dtype=fields)
+        rec["n"] = len(columns)
+        for k, (_, values) in enumerate(columns):
+            if pattern[k]:
+                rec[f"l{k}"] = -1
+            else:
+                rec[f"l{k}"] = values.dtype.itemsize
+                rec[f"v{k}"] = values[rows]
+        chunks.append(rec.tobytes())
+    return b"".join(chunks)
+
+class _ChunksFile:
+    """Read-only file over an iterator of bytes, what copy_expert needs to stream"""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buf = b""
+        self._pos = 0
+
+    def read(self, size=-1):
+        while self._pos >= len(self._buf):
+            self._buf = next(self._chunks, None)
+            self._pos = 0
+            if self._buf is None:
+                self._buf = b""
+                return b""
+        end = len(self._buf) if size is None or size < 0 else self._pos + size
+        data = self._buf[self._pos:end]
+        self._pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
 class TimescaleStockMarketModel:
     """ Bourse model with TimeScaleDB persistence."""
 
-    def __init__(self, database, user=None, host=None, password=None, port=None, remove_all=False):
+    def __init__(self, database, user=None, host=None, password=None, port=None, remove_all=False, setup=True,
+                 compress_after="30 days"):
         """Create a TimescaleStockMarketModel
 
         database -- The name of the persistence database.
         user     -- Username to connect with to the database. Same as the
                     database name by default.
         remove_all -- REMOVE ALL DATA from the database
+        setup    -- create the schema if needed, False for the extra connections
+                    of a run once the schema is there
+        compress_after -- age of the stocks and daystocks chunks compressed by the
+                    TimescaleDB policy (a Postgres interval), None for no policy
         """
         self.__database = database
         self.__user = user or database
@@ -74,6 +200,13 @@ class TimescaleStockMarketModel:
         self.__port = port or 5432
         self.__password = password or ''
         self.__squash = False
+        self.__column_types = {}
+        self.bulk_load = False  # see begin_bulk_load
+        self.compress_after = compress_after
+        self.spool = None       # see use_spool
+        self.spool_wait = 0
+        self.__retry_at = 0
+        self.__reconnect_at = 0  # see _ensure_connection
         self.__engine = sqlalchemy.create_engine(f"timescaledb://{self.__user}:{self.__password}@{self.__host}:{self.__port}/{self.__database}")
         # markets
         self.market_id = {a:i+1 for i,a in enumerate([m[2] for m in initial_markets_data])}
@@ -88,10 +221,11 @@ class TimescaleStockMarketModel:
         self.logger = mylogging.getLogger(__name__, filename="/tmp/bourse.log")
         self.connection = self._connect_to_database()
 
-        self.logger.info("Setup database generates an error if it exists already, it's ok")
         if remove_all:
             self._purge_database()
-        self._setup_database()
+        if setup:
+            self.logger.info("Setup database generates an error if it exists already, it's ok")
+            self._setup_database()
 
     def _connect_to_database(self, retry_limit=5, retry_delay=1):
         """
@@ -105,6 +239,7 @@ class TimescaleStockMarketModel:
                     user=self.__user,
                     host=self.__host,
                     password=self.__password,
+                    connect_timeout=10,
                 )
                 return connection
             except Exception as e:
@@ -112,6 +247,31 @@ class TimescaleStockMarketModel:
                 time.sleep(retry_delay)
         raise Exception("Failed to connect to database after multiple attempts")
 
+    def _ensure_connection(self):
+        """Reopen the connection lost during an outage before using it.
+
+        Raises psycopg2.OperationalError while the database is unreachable, a
+        new attempt is made every 5 s at most so that a long outage does not
+        wait for a connect timeout at each query.
+        """
+        if not self.connection.closed:
+            return
+        if time.monotonic() < self.__reconnect_at:
+            raise psycopg2.OperationalError("database unreachable, connection closed")
+        try:
+            self.connection = self._connect_to_database(retry_limit=1, retry_delay=0)
+        except Exception as e:
+            self.__reconnect_at = time.monotonic() + 5
+            raise psycopg2.OperationalError(str(e))
+
+    def _rollback(self):
+        """Rollback after an error, nothing to do when the connection is lost"""
+        if not self.connection.closed:
+            try:
+                self.connection.rollback()
+            except CONNECTION_ERRORS:
+                pass
+
     def _create_sequence(self, sequence_name, commit=False):
         """Create a sequence in the database."""
         cursor = self.connection.cursor()
@@ -134,11 +294,11 @@ class TimescaleStockMarketModel:
             print(f"Error dropping sequence: {e}")
             self.connection.rollback()  # Rollback the current transaction
 
-    def _create_table(self, table_name, columns_definition, commit=False):
+    def _create_table(self, table_name, columns_definition, commit=False, if_not_exists=False):
         """Create a table in the database."""
         cursor = self.connection.cursor()
         try:
-            cursor.execute(f"CREATE TABLE {table_name} ({columns_definition});")
+            cursor.execute(f"CREATE TABLE {'IF NOT EXISTS ' if if_not_exists else ''}{table_name} ({columns_definition});")
             if commit:
                 self.connection.commit()
         except Exception as e:
@@ -180,11 +340,12 @@ class TimescaleStockMarketModel:
             print(f"Error dropping hypertable: {e}")
             self.connection.rollback()  # Rollback the current transaction
 
-    def _create_index(self, table_name, index_name, columns, commit=False):
+    def _create_index(self, table_name, index_name, columns, unique=False, commit=False):
         """Create an index in the database."""
         cursor = self.connection.cursor()
         try:
-            cursor.execute(f"CREATE INDEX {index_name} ON {table_name} ({columns});")
+            kind = "UNIQUE INDEX" if unique else "INDEX"
+            cursor.execute(f"CREATE {kind} {index_name} ON {table_name} ({columns});")
             if commit:
                 self.connection.commit()
         except Exception as e:
@@ -202,6 +363,58 @@ class TimescaleStockMarketModel:
             print(f"Error dropping index: {e}")
             self.connection.rollback()  # Rollback the current transaction
 
+    def _drop_view(self, view_name, materialized=False, commit=False):
+        """Drop a view from the database."""
+        cursor = self.connection.cursor()
+        kind = "MATERIALIZED VIEW" if materialized else "VIEW"
+        try:
+            cursor.execute(f"DROP {kind} IF EXISTS {view_name} CASCADE;")
+            if commit:
+                self.connection.commit()
+        except Exception as e:
+            print(f"Error dropping view: {e}")
+            self.connection.rollback()  # Rollback the current transaction
+
+    def _create_daystocks_views(self):
+        """Daily values computed from stocks, for the companies Euronext does not cover.
+
+        daystocks_intraday is a continuous aggregate of stocks by day, refreshed by
+        a TimescaleDB policy for the last days and by the ETL after a load.
+        Boursorama volumes are cumulated over the day so the daily volume is the
+        max. daystocks_all is what the dashboard reads: the Euronext daystocks
+        and the intraday ones for the (company, day) Euronext did not give.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                CREATE MATERIALIZED VIEW IF NOT EXISTS daystocks_intraday
+                WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+                SELECT time_bucket('1 day', date) AS day, cid,
+                       first(value, date) AS open, last(value, date) AS close,
+                       max(value) AS high, min(value) AS low, max(volume) AS volume,
+                       avg(value) AS mean, stddev(value) AS std
+                FROM stocks
+                GROUP BY day, cid
+                WITH NO DATA;
+            """)
+            cursor.execute("""
+                SELECT add_continuous_aggregate_policy('daystocks_intraday',
+                    start_offset => INTERVAL '3 days', end_offset => INTERVAL '1 hour',
+                    schedule_interval => INTERVAL '1 hour', if_not_exists => true);
+            """)
+            cursor.execute("""
+                CREATE OR REPLACE VIEW daystocks_all AS
+                SELECT date, cid, open, close, high, low, volume, mean, std FROM daystocks
+                UNION ALL
+                SELECT i.day, i.cid, i.open, i.close, i.high, i.low, i.volume, i.mean::FLOAT4, i.std::FLOAT4
+                FROM daystocks_intraday i
+                WHERE NOT EXISTS (SELECT 1 FROM daystocks d WHERE d.cid = i.cid AND d.date = i.day);
+            """)
+            self.connection.commit()
+        except Exception as e:
+            print(f"Error creating daystocks views: {e}")
+            self.connection.rollback()  # Rollback the current transaction
+
     def _insert_data(self, table_name, data, commit=False):
         """Insert data into a table in the database."""
         cursor = self.connection.cursor()
@@ -282,9 +495,9 @@ class TimescaleStockMarketModel:
                 self._create_hypertable("stocks", "date")
                 self._create_hypertable("daystocks", "date")
 
-                # Create indexes
-                self._create_index("stocks", "idx_cid_stocks", "cid, date DESC")
-                self._create_index("daystocks", "idx_cid_daystocks", "cid, date DESC")
+                # Create indexes, unique so that loads can merge rows (see copy_merge)
+                self._create_index("stocks", "idx_cid_stocks", "cid, date DESC", unique=True)
+                self._create_index("daystocks", "idx_cid_daystocks", "cid, date DESC", unique=True)
 
                 # Insert initial market data
                 self._insert_data("markets", initial_markets_data)
@@ -294,8 +507,76 @@ class TimescaleStockMarketModel:
         except Exception as e:
             self.logger.exception("SQL error: %s" % e)
             self.connection.rollback()
+        # after the tables, also for databases created before these views and indexes
+        # Boursorama symbols of no company, see add_unmatched_symbols
+        self._create_table(
+            "unmatched_symbols",
+            "symbol VARCHAR PRIMARY KEY, rows BIGINT, first_date TIMESTAMPTZ, last_date TIMESTAMPTZ",
+            commit=True, if_not_exists=True,
+        )
+        self._create_daystocks_views()
+        self._make_index_unique("stocks", "idx_cid_stocks")
+        self._make_index_unique("daystocks", "idx_cid_daystocks")
+        # a bulk load which crashed before end_bulk_load left its table without index
+        for index in bulk_indexes:
+            self._build_index(*index)
+        self._setup_compression("stocks", self.compress_after)
+        self._setup_compression("daystocks", self.compress_after)
+
+    def _setup_compression(self, table_name, compress_after):
+        """Compress the chunks of table by company, ordered by date, after compress_after.
+
+        A company reads one compressed segment of a chunk instead of pages shared
+        with all the others. The (cid, date) unique index is compatible as cid is
+        the segment and date the order.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("SELECT compression_enabled FROM timescaledb_information.hypertables "
+                           "WHERE hypertable_name = %s;", (table_name,))
+            row = cursor.fetchone()
+            if row is None:
+                self.connection.rollback()
+                return
+            if not row[0]:
+                cursor.execute(f"""
+                    ALTER TABLE {table_name} SET (timescaledb.compress,
+                        timescaledb.compress_segmentby = 'cid', timescaledb.compress_orderby = 'date DESC');
+                """)
+            # replaced so that a new compress_after is taken into account
+            cursor.execute("SELECT remove_compression_policy(%s, if_exists => true);", (table_name,))
+            if compress_after is not None:
+                cursor.execute("SELECT add_compression_policy(%s, %s::interval);", (table_name, compress_after))
+            self.connection.commit()
+        except Exception as e:
+            print(f"Error setting compression of {table_name}: {e}")
+            self.connection.rollback()  # Rollback the current transaction
+
+    def _make_index_unique(self, table_name, index_name):
+        """Replace a non unique (cid, date) index, removing the duplicated rows first.
+
+        Only does something on databases created when the index was not unique.
+        """
+        rows = self.raw_query("SELECT indisunique FROM pg_index WHERE indexrelid = to_regclass(%s)", (index_name,))
+        if not rows or rows[0][0]:
+            return
+        print(f"Suppression des doublons de {table_name} pour rendre {index_name} unique")
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(f"""
+                DELETE FROM {table_name} a USING {table_name} b
+                WHERE a.cid = b.cid AND a.date = b.date AND a.ctid < b.ctid;
+            """)
+            cursor.execute(f"DROP INDEX {index_name};")
+            cursor.execute(f"CREATE UNIQUE INDEX {index_name} ON {table_name} (cid, date DESC);")
+            self.connection.commit()
+        except Exception as e:
+            print(f"Error making index unique: {e}")
+            self.connection.rollback()  # Rollback the current transaction
 
     def _purge_database(self):
+        self._drop_view("daystocks_all")
+        self._drop_view("daystocks_intraday", materialized=True)
         self._drop_table("markets")
         self._drop_table("companies")
         self._drop_table("stocks")
@@ -303,6 +584,7 @@ class TimescaleStockMarketModel:
         self._drop_table("file_done")
         self._drop_table("tags")
         self._drop_table("error_dates")
+        self._drop_table("unmatched_symbols")
 
         self._drop_sequence("market_id_seq")
         self._drop_sequence("company_id_seq")
@@ -334,28 +616,487 @@ class TimescaleStockMarketModel:
 
 
     def df_write(self, df, table, args=None, commit=False, if_exists="append", 
-                 index=False, index_label=None, chunksize=100, dtype=None, method= _psql_insert_copy):
+                 index=False, index_label=None, chunksize=100, dtype=None, method=None,
+                 done=None, merge=False, spool=True):
         """Write a Pandas dataframe to the Postgres SQL database
 
+        df may also be a list of dataframes with the same columns when it goes
+        through copy_write or copy_merge, they are written with one COPY.
+
         :param query:
         :param args: arguments for the query
         :param commit: do a commit after writing
+        :param done: names of the files the rows come from, recorded in file_done
+                     in the same transaction as the rows
+        :param method: None appends df with copy_write, otherwise df goes through
+                       to_sql with this method (_psql_insert_copy for instance)
+        :param merge: merge the rows with copy_merge, rows already there are updated.
+                      Ignored during a bulk load, the table was empty.
         :param other args: see https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.to_sql.html
+
+        With a spool (see use_spool) rows go to the spool when the database
+        cannot be reached, or while older rows are waiting there. spool=False
+        writes now and raises if the database is unreachable.
         """
         self.logger.debug("df_write")
-        df.to_sql(
-            table,
-            con = self.__engine,
-            if_exists=if_exists,
-            index=index,
-            index_label=index_label,
-            chunksize=chunksize,
-            dtype=dtype,
-            method=method,
-        )
+        if spool and self.spool is not None and method is None and if_exists == "append" and not index and dtype is None:
+            self._spooled_write(df, table, done, merge)
+            return
+        self._write(df, table, if_exists, index, index_label, chunksize, dtype, method, done, merge)
         if commit:
             self.commit()
 
+    def _write(self, df, table, if_exists="append", index=False, index_label=None, chunksize=100, dtype=None,
+               method=None, done=None, merge=False):
+        self._ensure_connection()
+        if merge and not self.bulk_load:
+            self.copy_merge(df, table, done=done)
+            return
+        if method is None and if_exists == "append" and not index and dtype is None:
+            self.copy_write(df, table, done=done)
+            return
+        with self.__engine.begin() as conn:
+            df.to_sql(
+                table,
+                con = conn,
+                if_exists=if_exists,
+                index=index,
+                index_label=index_label,
+                chunksize=chunksize,
+                dtype=dtype,
+                method=method,
+            )
+            if done:
+                conn.exec_driver_sql(
+                    "INSERT INTO file_done (name) VALUES (%(name)s) ON CONFLICT DO NOTHING",
+                    [{"name": name} for name in done],
+                )
+
+    def copy_write(self, frames, table, flush_rows=100000, binary=True, done=None):
+        """Append a dataframe, or an iterator of dataframes with the same columns,
+        to table with a single COPY and commit.
+
+        Frames are encoded flush_rows rows at a time and streamed to the server,
+        so memory holds one encoded chunk whatever the total size. The binary
+        format is used when every column has a fixed size type in the table,
+        CSV otherwise (text columns).
+
+        :param done: names of files recorded in file_done in the same transaction
+        """
+        cursor = self.connection.cursor()
+        try:
+            self._copy(cursor, frames, table, flush_rows, binary)
+            self._record_done(cursor, done)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+
+    def copy_merge(self, frames, table, key=("cid", "date"), flush_rows=100000, binary=True, done=None):
+        """Like copy_write but loading the same rows twice does not duplicate them.
+
+        Frames are copied into a temporary staging table, then merged into table
+        with one INSERT ... ON CONFLICT on the unique index of key: existing rows
+        are updated with the new values. Rows with a NULL in key are dropped and
+        duplicates inside the frames are merged once.
+        """
+        staging = f"{table}_staging"
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging} "
+                           f"(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;")
+            columns = self._copy(cursor, frames, staging, flush_rows, binary, types_of=table)
+            if columns is None:
+                self.connection.rollback()
+                return
+            names = ", ".join('"{}"'.format(c) for c in columns)
+            keys = ", ".join(key)
+            updates = ", ".join('"{0}" = EXCLUDED."{0}"'.format(c) for c in columns if c not in key)
+            action = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+            not_null = " AND ".join(f"{k} IS NOT NULL" for k in key)
+            cursor.execute(f"""
+                INSERT INTO {table} ({names})
+                SELECT DISTINCT ON ({keys}) {names} FROM {staging} WHERE {not_null}
+                ON CONFLICT ({keys}) {action};
+            """)
+            self.logger.debug(f"copy_merge: {cursor.rowcount} rows merged into {table}")
+            self._record_done(cursor, done)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+
+    def _copy(self, cursor, frames, table, flush_rows=100000, binary=True, types_of=None):
+        """Stream frames into table with one COPY on cursor, without committing.
+
+        Returns the columns copied, None when there was no frame.
+        types_of -- table whose column types are used to encode, table by default
+        """
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+        frames = iter(frames)
+        first = next(frames, None)
+        if first is None:
+            return None
+        frames = itertools.chain([first], frames)
+
+        columns = list(first.columns)
+        pg_types = self._column_types(types_of or table)
+        binary = binary and all(pg_types.get(c) in _binary_types for c in columns)
+        names = ", ".join('"{}"'.format(c) for c in columns)
+        if binary:
+            sql = f"COPY {table} ({names}) FROM STDIN WITH (FORMAT binary)"
+            timezone = self._timezone()
+        else:
+            sql = f"COPY {table} ({names}) FROM STDIN WITH CSV"
+
+        def chunks():
+            if binary:
+                yield PGCOPY_HEADER
+            for df in frames:
+                for start in range(0, len(df), flush_rows):
+                    part = df.iloc[start:start + flush_rows][columns]
+                    if binary:
+                        yield _encode_binary(part, pg_types, timezone)
+                    else:
+                        yield part.to_csv(header=False, index=False).encode()
+            if binary:
+                yield PGCOPY_TRAILER
+
+        self.logger.debug(f"copy: {sql}")
+        cursor.copy_expert(sql, _ChunksFile(chunks()), size=1 << 20)
+        return columns
+
+    def _record_done(self, cursor, done):
+        if done:
+            cursor.executemany("INSERT INTO file_done (name) VALUES (%s) ON CONFLICT DO NOTHING;",
+                               [(name,) for name in done])
+
+    def _column_types(self, table):
+        """Return {column: postgres type name} of table, cached"""
+        if table not in self.__column_types:
+            rows = self.raw_query(
+                """SELECT a.attname, t.typname FROM pg_attribute a JOIN pg_type t ON t.oid = a.atttypid
+                   WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped""",
+                (table,))
+            self.__column_types[table] = dict(rows or [])
+        return self.__column_types[table]
+
+    def _timezone(self):
+        """Time zone of the session, used to store naive dates as the server would"""
+        rows = self.raw_query("SELECT current_setting('TimeZone')")
+        return rows[0][0] if rows else "UTC"
+
+    def refresh_daystocks(self, start, end):
+        """Materialize daystocks_intraday for the days between start and end (included)"""
+        self.logger.debug(f"refresh_daystocks {start} {end}")
+        try:
+            self.connection.commit()
+            self.connection.autocommit = True  # refresh_continuous_aggregate refuses transactions
+            cursor = self.connection.cursor()
+            cursor.execute("CALL refresh_continuous_aggregate('daystocks_intraday', %s::timestamptz, "
+                           "%s::timestamptz + INTERVAL '1 day');", (str(start), str(end)))
+        except Exception as e:
+            self.logger.error(f"Exception with refresh_daystocks: {e}")
+        finally:
+            if not self.connection.closed:
+                self.connection.autocommit = False
+
+    # spool
+
+    def use_spool(self, spool, wait=0):
+        """Keep the batches df_write cannot write in spool (see spool.Spool)
+
+        wait -- seconds replay_spool waits for the database by default
+        """
+        self.spool = spool
+        self.spool_wait = wait
+
+    def _spooled_write(self, frames, table, done, merge):
+        """Write, or spool if the database is unreachable. Older batches are written first."""
+        if self.spool.pending():
+            # une nouvelle tentative toutes les 5 s au plus, l'ETL continue en attendant
+            if time.monotonic() < self.__retry_at or not self.replay_spool(wait=0):
+                self.__retry_at = time.monotonic() + 5
+                self.spool.put(table, frames, done, merge)
+                return
+        try:
+            self._write(frames, table, done=done, merge=merge)
+        except CONNECTION_ERRORS as e:
+            self.logger.error(f"Database unreachable, batch spooled: {e}")
+            print(f"Base injoignable, lot de {table} mis en attente dans {self.spool.folder}")
+            if not isinstance(frames, pd.DataFrame):
+                frames = list(frames)  # an iterator may have been partly read by the COPY
+            self.spool.put(table, frames, done, merge)
+            self.__retry_at = time.monotonic() + 5
+
+    def replay_spool(self, wait=None, concurrency=2):
+        """Write the spooled batches in order, return True once the spool is empty.
+
+        Consecutive append batches are written by up to concurrency connections
+        at the same time, a merge batch waits for the previous ones so that the
+        last values win.
+        wait -- seconds to keep retrying while the database is unreachable,
+                spool_wait by default
+        """
+        if self.spool is None:
+            return True
+        deadline = time.monotonic() + (self.spool_wait if wait is None else wait)
+        delay = 1
+        while not self._replay_spool(concurrency):
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+            delay = min(2 * delay, 60)
+        return True
+
+    def _replay_spool(self, concurrency):
+        batches = self.spool.pending()
+        if not batches:
+            return True
+        if not self._reconnect():
+            return False
+        print(f"Écriture des {len(batches)} lots en attente dans {self.spool.folder}")
+        sessions = [self]
+        try:
+            return self._replay_batches(batches, sessions, concurrency)
+        finally:
+            for session in sessions[1:]:
+                session.connection.close()
+
+    def _replay_batches(self, batches, sessions, concurrency):
+        i = 0
+        while i < len(batches):
+            group = [batches[i]]
+            if not self.spool.meta(batches[i])["merge"]:
+                while (len(group) < concurrency and i + len(group) < len(batches)
+                       and not self.spool.meta(batches[i + len(group)])["merge"]):
+                    group.append(batches[i + len(group)])
+            while len(sessions) < len(group):
+                try:
+                    session = TimescaleStockMarketModel(self.__database, self.__user, self.__host,
+                                                        self.__password, self.__port, setup=False)
+                except Exception:
+                    break
+                session.bulk_load = self.bulk_load
+                sessions.append(session)
+            group = group[:len(sessions)]
+            if len(group) == 1:
+                ok = [self._replay_batch(group[0])]
+            else:
+                ok = [False] * len(group)
+                def replay(k):
+                    ok[k] = sessions[k]._replay_batch(group[k], self.spool)
+                threads = [threading.Thread(target=replay, args=(k,)) for k in range(len(group))]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            if not all(ok):
+                return False
+            i += len(group)
+        return True
+
+    def _replay_batch(self, batch, spool=None):
+        """Write one spooled batch, False if the database is unreachable"""
+        spool = spool or self.spool
+        try:
+            table, frame, done, merge = spool.load(batch)
+            self._write(frame, table, done=done, merge=merge)
+        except CONNECTION_ERRORS as e:
+            self.logger.error(f"Database still unreachable: {e}")
+            return False
+        except Exception as e:
+            print(f"Lot {batch} refusé par la base, mis de côté : {e}")
+            spool.reject(batch)
+            return True
+        spool.remove(batch)
+        return True
+
+    def _reconnect(self):
+        """Open a new connection if the current one is lost, False while the database is unreachable.
+
+        The transaction of the caller, if any, is left alone: the ping is only
+        rolled back when it opened the transaction itself.
+        """
+        extensions = psycopg2.extensions
+        if not self.connection.closed:
+            status = self.connection.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_INERROR:
+                return False  # up to the caller to roll back its transaction
+            if status in (extensions.TRANSACTION_STATUS_IDLE, extensions.TRANSACTION_STATUS_INTRANS):
+                try:
+                    self.connection.cursor().execute("SELECT 1")
+                    if status == extensions.TRANSACTION_STATUS_IDLE:
+                        self.connection.rollback()
+                    return True
+                except CONNECTION_ERRORS:
+                    pass
+            try:  # lost, closed before being replaced
+                self.connection.close()
+            except Exception:
+                pass
+        try:
+            self.connection = self._connect_to_database(retry_limit=1)
+            return True
+        except Exception:
+            return False
+
+    # bulk loading
+
+    def is_empty(self, table):
+        """True when table has no row"""
+        rows = self.raw_query(f"SELECT NOT EXISTS (SELECT 1 FROM {table})")
+        return bool(rows and rows[0][0])
+
+    def begin_bulk_load(self):
+        """Drop the (cid, date) and date indexes before filling empty tables.
+
+        COPY then appends rows without maintaining any B-tree. Merging needs the
+        unique indexes so df_write appends until end_bulk_load rebuilds them.
+        """
+        self.logger.info("begin_bulk_load")
+        for table_name, index_name, columns, unique in bulk_indexes:
+            self._drop_index(index_name, commit=True)
+        # a backfill is old enough for the policy, which must not compress chunks being written
+        self.schedule_compression(False)
+        self.bulk_load = True
+
+    def end_bulk_load(self):
+        """Rebuild the indexes dropped by begin_bulk_load, at the same time on
+        one connection each, then ANALYZE the tables."""
+        self.logger.info("end_bulk_load")
+        threads = [threading.Thread(target=self._build_index, args=index) for index in bulk_indexes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.bulk_load = False
+        cursor = self.connection.cursor()
+        try:
+            for table_name in ("companies", "stocks", "daystocks"):
+                cursor.execute(f"ANALYZE {table_name};")
+            self.connection.commit()
+        except Exception as e:
+            self.logger.error(f"Exception with ANALYZE: {e}")
+            self.connection.rollback()
+
+    def _build_index(self, table_name, index_name, columns, unique=True):
+        """Create the index if it is missing, on a connection of its own.
+
+        Duplicated (cid, date) rows, which a bulk load does not prevent, are
+        removed when a unique index cannot be created because of them.
+        """
+        connection = self._connect_to_database()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT to_regclass(%s)", (index_name,))
+            if cursor.fetchone()[0] is not None:
+                return
+            print(f"Création de l'index {index_name}")
+            kind = "UNIQUE INDEX" if unique else "INDEX"
+            try:
+                cursor.execute(f"CREATE {kind} {index_name} ON {table_name} ({columns});")
+            except psycopg2.errors.UniqueViolation:
+                connection.rollback()
+                print(f"Suppression des doublons de {table_name} pour créer {index_name}")
+                cursor.execute(f"""
+                    DELETE FROM {table_name} a USING {table_name} b
+                    WHERE a.cid = b.cid AND a.date = b.date AND a.ctid < b.ctid;
+                """)
+                cursor.execute(f"CREATE UNIQUE INDEX {index_name} ON {table_name} ({columns});")
+            connection.commit()
+        except Exception as e:
+            self.logger.error(f"Exception with _build_index {index_name}: {e}")
+            connection.rollback()
+        finally:
+            connection.close()
+
+    def schedule_compression(self, scheduled, tables=("stocks", "daystocks")):
+        """Pause (False) or resume (True) the compression policy jobs of tables.
+
+        begin_bulk_load pauses them, the ETL resumes them after compress_chunks.
+        A run stopped in between gets them back at the next setup, which
+        replaces the policies.
+        """
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute("""
+                SELECT alter_job(job_id, scheduled => %s) FROM timescaledb_information.jobs
+                WHERE proc_name = 'policy_compression' AND hypertable_name = ANY(%s);
+            """, (scheduled, list(tables)))
+            self.connection.commit()
+        except Exception as e:
+            self.logger.error(f"Exception with schedule_compression: {e}")
+            self.connection.rollback()
+
+    def compress_chunks(self, older_than=None, tables=("stocks", "daystocks")):
+        """Compress the chunks older than older_than (compress_after by default) now.
+
+        The policy compresses the chunks of a backfill over its next runs, this
+        does it at the end of the load. One transaction per chunk.
+        Returns the number of chunks compressed.
+        """
+        older_than = older_than or self.compress_after
+        if older_than is None:
+            return 0
+        count = 0
+        for table_name in tables:
+            chunks = self.raw_query(
+                """SELECT format('%%I.%%I', chunk_schema, chunk_name) FROM timescaledb_information.chunks
+                   WHERE hypertable_name = %s AND NOT is_compressed AND range_end < now() - %s::interval
+                   ORDER BY range_start""",
+                (table_name, older_than))
+            for (chunk,) in chunks or []:
+                cursor = self.connection.cursor()
+                try:
+                    cursor.execute("SELECT compress_chunk(%s::regclass, if_not_compressed => true);", (chunk,))
+                    self.connection.commit()
+                    count += 1
+                except Exception as e:
+                    self.logger.error(f"Exception with compress_chunk {chunk}: {e}")
+                    self.connection.rollback()
+        return count
+
+    def add_unmatched_symbols(self, rows):
+        """Add (symbol, rows, first date, last date) to unmatched_symbols,
+        rows are summed and dates extended for the symbols already there."""
+        try:
+            self._ensure_connection()
+            cursor = self.connection.cursor()
+            psycopg2.extras.execute_values(cursor, """
+                INSERT INTO unmatched_symbols (symbol, rows, first_date, last_date) VALUES %s
+                ON CONFLICT (symbol) DO UPDATE SET
+                    rows = unmatched_symbols.rows + EXCLUDED.rows,
+                    first_date = LEAST(unmatched_symbols.first_date, EXCLUDED.first_date),
+                    last_date = GREATEST(unmatched_symbols.last_date, EXCLUDED.last_date);
+            """, rows)
+            self.connection.commit()
+        except Exception as e:
+            self.logger.error(f"Exception with add_unmatched_symbols: {e}")
+            self._rollback()
+
+    # file_done bookkeeping
+
+    def done_files(self):
+        """Return the set of file names already loaded"""
+        return {row[0] for row in self.raw_query("SELECT name FROM file_done") or []}
+
+    def mark_files_done(self, names, commit=True):
+        """Record files which gave no rows to write, False if it failed"""
+        try:
+            self._ensure_connection()
+            cursor = self.connection.cursor()
+            cursor.executemany("INSERT INTO file_done (name) VALUES (%s) ON CONFLICT DO NOTHING;",
+                               [(name,) for name in names])
+            if commit:
+                self.commit()
+            return True
+        except Exception as e:
+            self.logger.error(f"Exception with mark_files_done: {e}")
+            self._rollback()
+            return False
+
     # general query methods
 
     def raw_query(self, query, args=None, cursor=None):
@@ -365,17 +1106,17 @@ class TimescaleStockMarketModel:
         else:
             pretty = '%s %% %r' % (query, args)
         self.logger.debug('SQL: QUERY: %s' % pretty)
-        if cursor is None:
-            cursor = self.connection.cursor()
         try:
+            if cursor is None:
+                self._ensure_connection()
+                cursor = self.connection.cursor()
             cursor.execute(query, args)
             query = query.strip().upper()
             if query.startswith('SELECT'):
                 return cursor.fetchall()
         except Exception as e:
             self.logger.error(f"Exception with raw_query: {e}")
-            if self.connection:
-                self.connection.rollback()
+            self._rollback()
 
     def df_query(self, query, args=None, index_col=None, coerce_float=True, params=None, 
                  parse_dates=None, columns=None, chunksize=None, dtype=None):
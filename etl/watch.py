@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+'''
+  Surveillance des dossiers de données pour le mode --watch de l'ETL.
+
+  Avec inotify_simple (Linux) un fichier est signalé dès qu'il est fermé après
+  écriture. Sinon les dossiers sont parcourus toutes les interval secondes et
+  un fichier est signalé quand sa taille et sa date n'ont pas bougé entre deux
+  parcours, pour ne pas lire un fichier en cours d'écriture.
+'''
+
+import os
+import time
+
+try:
+    import inotify_simple
+except ImportError:  # pas sous Linux ou pas installé
+    inotify_simple = None
+
+
+def _scan(folders):
+    """{path: (size, mtime)} of the files under folders"""
+    files = {}
+    for folder in folders:
+        for root, dirs, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # removed in the meantime
+                    continue
+                files[path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+class PollingWatcher:
+    """New files of folders, found by scanning them every interval seconds.
+
+    Iterating yields the list of the files ready since the previous item,
+    possibly empty. The files already there at creation are never yielded.
+    """
+
+    def __init__(self, folders, interval=5):
+        self.folders = folders
+        self.interval = interval
+        self.seen = set(_scan(folders))
+        self.pending = {}
+
+    def __iter__(self):
+        while True:
+            time.sleep(self.interval)
+            yield self.poll()
+
+    def poll(self):
+        """Return the new files whose size and date did not change since the previous scan"""
+        ready = []
+        pending = {}
+        for path, stat in _scan(self.folders).items():
+            if path in self.seen:
+                continue
+            if self.pending.get(path) == stat:
+                ready.append(path)
+                self.seen.add(path)
+            else:
+                pending[path] = stat
+        self.pending = pending
+        return sorted(ready)
+
+
+class InotifyWatcher:
+    """New files of folders and of their new subfolders, signaled by inotify.
+
+    Iterating yields the files written during the last interval seconds at
+    most, as soon as some are.
+    """
+
+    def __init__(self, folders, interval=5):
+        self.inotify = inotify_simple.INotify()
+        self.interval = interval
+        self.dirs = {}
+        self.ready = []
+        for folder in folders:
+            self._watch_tree(folder, initial=True)
+
+    def _watch_tree(self, folder, initial=False):
+        flags = inotify_simple.flags
+        for root, dirs, names in os.walk(folder):
+            wd = self.inotify.add_watch(root, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+            self.dirs[wd] = root
+            if not initial:  # written before the watch was added
+                self.ready.extend(os.path.join(root, name) for name in names)
+
+    def __iter__(self):
+        while True:
+            yield self.poll()
+
+    def poll(self):
+        """Wait up to interval seconds for files, return those written"""
+        flags = inotify_simple.flags
+        for event in self.inotify.read(timeout=int(self.interval * 1000), read_delay=200):
+            folder = self.dirs.get(event.wd)
+            if folder is None or not event.name:
+                continue
+            path = os.path.join(folder, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self._watch_tree(path)
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                self.ready.append(path)
+        ready, self.ready = sorted(set(self.ready)), []
+        return ready
+
+
+def watcher(folders, interval=5):
+    """InotifyWatcher when inotify is available, PollingWatcher otherwise"""
+    folders = [folder for folder in folders if os.path.isdir(folder)]
+    if inotify_simple is not None:
+        try:
+            return InotifyWatcher(folders, interval)
+        except OSError as e:  # plus de watch disponibles (fs.inotify.max_user_watches)...
+            print(f"inotify indisponible ({e}), parcours des dossiers toutes les {interval} s")
+    return PollingWatcher(folders, interval)